@@ -0,0 +1,228 @@
+# xipspace
+
+import argparse
+import importlib.util
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import numpy as np
+from PIL import Image
+import fitz
+
+PDF_LAB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pdf-lab.py')
+
+# Seconds pdf-lab.py may take to import, and the backends it must not import up front
+IMPORT_BUDGET = 0.1
+HEAVY_MODULES = ('cv2', 'numpy', 'PIL', 'fitz')
+
+def load_pdf_lab():
+    # pdf-lab.py is not importable by name, registering it lets pool workers unpickle its functions
+    path = PDF_LAB_PATH
+    spec = importlib.util.spec_from_file_location('pdf_lab', path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['pdf_lab'] = module
+    spec.loader.exec_module(module)
+    return module
+
+pdf_lab = load_pdf_lab()
+pdf_lab.load_backends(*pdf_lab.IMAGE_BACKENDS)
+
+LOREM = ("Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor incididunt ut labore "
+         "et dolore magna aliqua. Ut enim ad minim veniam, quis nostrud exercitation ullamco laboris nisi ut "
+         "aliquip ex ea commodo consequat. ")
+
+# Page size in points and scan resolution for each synthetic document kind
+DOCUMENT_KINDS = {
+    'text': (fitz.paper_rect('a4'), None),
+    'scanned': (fitz.paper_rect('a4'), 150),
+    'large': (fitz.paper_rect('a0'), 100),
+}
+
+def make_scan_image(width, height, seed):
+    rng = np.random.default_rng(seed)
+    image = np.full((height, width), 235, dtype=np.uint8)
+    margin = width // 12
+    line_height = max(8, height // 60)
+
+    # Dark word blocks on lines, then sensor noise over the whole page
+    for top in range(line_height * 3, height - line_height * 3, line_height * 2):
+        left = margin
+        while left < width - margin:
+            word = int(rng.integers(line_height, line_height * 6))
+            image[top:top + line_height, left:min(left + word, width - margin)] = 40
+            left += word + line_height
+
+    noise = rng.normal(0, 18, size=image.shape)
+    image = np.clip(image + noise, 0, 255).astype(np.uint8)
+
+    buffer = io.BytesIO()
+    Image.fromarray(image).save(buffer, 'JPEG', quality=75)
+    return buffer.getvalue()
+
+def make_document(path, kind, pages):
+    rect, scan_dpi = DOCUMENT_KINDS[kind]
+
+    with fitz.open() as doc:
+        for page_num in range(pages):
+            page = doc.new_page(width=rect.width, height=rect.height)
+            if scan_dpi:
+                width = int(rect.width * scan_dpi / 72)
+                height = int(rect.height * scan_dpi / 72)
+                page.insert_image(page.rect, stream=make_scan_image(width, height, page_num))
+            else:
+                page.insert_textbox(page.rect + (50, 50, -50, -50), f"Page {page_num + 1}\n" + LOREM * 30,
+                                    fontsize=11, fontname='helv')
+        doc.save(path, garbage=3, deflate=True)
+
+def check_import_budget(budget):
+    # A fresh interpreter, this process already has every backend loaded
+    code = ("import importlib.util, sys, time\n"
+            "start = time.perf_counter()\n"
+            f"spec = importlib.util.spec_from_file_location('pdf_lab', {PDF_LAB_PATH!r})\n"
+            "spec.loader.exec_module(importlib.util.module_from_spec(spec))\n"
+            "print(time.perf_counter() - start)\n"
+            f"print(','.join(name for name in {HEAVY_MODULES!r} if name in sys.modules))\n")
+    output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True).stdout
+    lines = output.splitlines()
+    elapsed, loaded = float(lines[0]), [name for name in lines[1:2] if name]
+
+    print(f"pdf-lab.py import: {elapsed * 1000:.1f} ms (budget {budget * 1000:.0f} ms)")
+    if loaded:
+        print(f"Backends imported at load time: {loaded[0]}")
+    return elapsed <= budget and not loaded
+
+def folder_size(folder):
+    return sum(entry.stat().st_size for entry in os.scandir(folder) if entry.is_file())
+
+def reset_peak_rss():
+    # Linux only, elsewhere the peak covers the whole benchmark process
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+    except OSError:
+        pass
+
+def stage_result(stage, pages, seconds, cpu_seconds, input_bytes, output_bytes):
+    return {
+        'stage': stage,
+        'pages': pages,
+        'seconds': seconds,
+        'cpu_seconds': cpu_seconds,
+        'pages_per_second': pages / seconds if seconds else None,
+        'mb_per_second': input_bytes / (1024 * 1024) / seconds if seconds else None,
+        'input_bytes': input_bytes,
+        'output_bytes': output_bytes,
+        'peak_rss_mb': pdf_lab.peak_rss_mb(),
+    }
+
+def run_document(pdf_path, pages, settings, workers):
+    work_folder = os.path.dirname(pdf_path)
+    split_folder = os.path.join(work_folder, 'split')
+    process_folder = os.path.join(work_folder, 'process')
+    folders = [split_folder]
+    results = []
+
+    def measure(stage, function, input_bytes, output_folder):
+        reset_peak_rss()
+        start_wall, start_cpu = time.perf_counter(), time.process_time()
+        function()
+        seconds, cpu_seconds = time.perf_counter() - start_wall, time.process_time() - start_cpu
+        results.append(stage_result(stage, pages, seconds, cpu_seconds, input_bytes, folder_size(output_folder)))
+
+    # Render and filter are timed apart on the same pages, in memory
+    reset_peak_rss()
+    render_seconds = filter_seconds = render_cpu = filter_cpu = 0
+    pixel_bytes = 0
+    with fitz.open(pdf_path) as doc:
+        for page in doc:
+            start_wall, start_cpu = time.perf_counter(), time.process_time()
+            image = pdf_lab.render_page_image(page, settings)
+            render_seconds += time.perf_counter() - start_wall
+            render_cpu += time.process_time() - start_cpu
+
+            start_wall, start_cpu = time.perf_counter(), time.process_time()
+            pdf_lab.filter_image(image, settings['color_mode'], settings['filters'])
+            filter_seconds += time.perf_counter() - start_wall
+            filter_cpu += time.process_time() - start_cpu
+            pixel_bytes += image.nbytes
+
+    input_bytes = os.path.getsize(pdf_path)
+    results.append(stage_result('render', pages, render_seconds, render_cpu, input_bytes, pixel_bytes))
+    results.append(stage_result('filter', pages, filter_seconds, filter_cpu, pixel_bytes, pixel_bytes))
+
+    measure('split_pdf', lambda: pdf_lab.split_pdf(pdf_path, split_folder), input_bytes, split_folder)
+    measure('treat_images', lambda: pdf_lab.treat_images(folders, workers, settings),
+            folder_size(split_folder), split_folder)
+    measure('convert_image_to_pdf', lambda: pdf_lab.convert_image_to_pdf(folders),
+            folder_size(split_folder), split_folder)
+    measure('merge_pdfs', lambda: pdf_lab.merge_pdfs(folders), folder_size(split_folder), split_folder)
+    measure('process_pdf', lambda: pdf_lab.process_pdf(pdf_path, process_folder, settings),
+            input_bytes, process_folder)
+
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the pdf-lab stages on synthetic documents.")
+    parser.add_argument('--kinds', nargs='+', choices=list(DOCUMENT_KINDS), default=list(DOCUMENT_KINDS))
+    parser.add_argument('--pages', nargs='+', type=int, default=[1, 10, 100])
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--dpi', type=int, default=pdf_lab.DEFAULT_SETTINGS['dpi'])
+    parser.add_argument('--max-width', type=int, default=pdf_lab.DEFAULT_SETTINGS['max_width'])
+    parser.add_argument('--color-mode', choices=('rgb', 'gray', 'bilevel'), default='rgb')
+    parser.add_argument('--output', help="Results file, defaults to bench_<timestamp>.json")
+    parser.add_argument('--keep', action='store_true', help="Keep the synthetic documents and stage outputs")
+    parser.add_argument('--check-import', action='store_true',
+                        help="Only check the pdf-lab.py import time against --import-budget, exit 1 when over")
+    parser.add_argument('--import-budget', type=float, default=IMPORT_BUDGET)
+    args = parser.parse_args()
+
+    if args.check_import:
+        sys.exit(0 if check_import_budget(args.import_budget) else 1)
+
+    # Benchmarks must measure the work, not the result cache
+    settings = {**pdf_lab.DEFAULT_SETTINGS, 'dpi': args.dpi, 'max_width': args.max_width,
+                'color_mode': args.color_mode, 'cache': False}
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    output_file = args.output or f"bench_{timestamp}.json"
+    root_folder = tempfile.mkdtemp(prefix='bench-lab-')
+    report = {'started': timestamp, 'workers': args.workers, 'settings': settings, 'results': []}
+
+    try:
+        for kind in args.kinds:
+            for pages in args.pages:
+                work_folder = os.path.join(root_folder, f"{kind}_{pages}")
+                os.makedirs(work_folder)
+                pdf_path = os.path.join(work_folder, f"{kind}_{pages}.pdf")
+                make_document(pdf_path, kind, pages)
+
+                # A fresh process per document keeps the peak memory figures apart
+                with ProcessPoolExecutor(max_workers=1) as executor:
+                    results = executor.submit(run_document, pdf_path, pages, settings, args.workers).result()
+
+                for result in results:
+                    result['kind'] = kind
+                    report['results'].append(result)
+                    print(f"{kind:8} {pages:5} {result['stage']:22} {result['seconds']:9.3f}s "
+                          f"{result['pages_per_second'] or 0:9.2f} p/s {result['mb_per_second'] or 0:9.2f} MB/s "
+                          f"{result['peak_rss_mb'] or 0:9.1f} MB")
+
+        with open(output_file, 'w') as json_file:
+            json.dump(report, json_file, indent=2)
+        print(f"Results written to {output_file}")
+
+    finally:
+        if args.keep:
+            print(f"Benchmark files kept in {root_folder}")
+        else:
+            shutil.rmtree(root_folder, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,11 @@
+import csv
 import json
 import os
 import re
+import sqlite3
 import openpyxl
 
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 
 # file handler
@@ -75,63 +78,70 @@ def list_headers(workbook, sheet_name):
 # model
 
 
+NON_ALPHANUMERIC = re.compile(r'[^a-zA-Z0-9]')
+
 def treat_code(code):
-    treated_code = re.sub(r'[^a-zA-Z0-9]', '', code).lower()
+    treated_code = NON_ALPHANUMERIC.sub('', str(code)).lower()
     treated_code = treated_code.replace('pdf', '')
     return treated_code
 
+def column_plan(header_cells):
+    # Worked out once per sheet: where code, label and cpl are, and which columns become properties.
+    # Columns without a header are ignored
+    headers = [str(cell.value).lower() if cell.value is not None and cell.value != "" else None for cell in header_cells]
+    code_index, label_index = headers.index("code"), headers.index("label")
+    cpl_index = headers.index("cpl") if "cpl" in headers else None
+
+    special = {code_index, label_index, cpl_index}
+    properties = [(i, header) for i, header in enumerate(headers) if header is not None and i not in special]
+
+    return {
+        "width": max(i for i, header in enumerate(headers) if header is not None) + 1,
+        "code": code_index,
+        "label": label_index,
+        "cpl": cpl_index,
+        "properties": properties,
+    }
+
+def sheet_records(sheet, category):
+    plan = column_plan(sheet[1])
+    width = plan["width"]
+    code_index, label_index, cpl_index = plan["code"], plan["label"], plan["cpl"]
+    properties = plan["properties"]
+    padding = (None,) * width
+
+    # Iterate over rows starting from the second row, columns past the last header are never read
+    for row in sheet.iter_rows(min_row=2, max_col=width, values_only=True):
+        if len(row) < width:
+            row = (row + padding)[:width]
+
+        # Extract code and label values
+        code, label = row[code_index], row[label_index]
+
+        if code and label is not None:
+            json_content = {"code": code}
+            if category:
+                json_content["category"] = category
+            json_content["label"] = label
+            json_content["properties"] = {header: row[i] for i, header in properties if row[i] is not None}
+            json_content["restrictions"] = {} if cpl_index is None else {"cpl": bool(row[cpl_index])}
+
+            yield treat_code(code), json_content
+
 def extract_data(workbook, sheet_name):
     try:
         json_data = {}
+        json_file = None
         
         category = input("Category for the Object: ")
         
         # Assuming sheet_name is the name of the sheet, we need to retrieve the actual sheet object
         sheet = workbook[sheet_name]
         
-        # Retrieve the headers from the first row of the sheet
-        header_row = [cell.value.lower() for cell in sheet[1] if cell.value]
-        
-        # Find the indices of 'code' and 'label' headers
-        code_index, label_index = header_row.index("code"), header_row.index("label")
-        
-        is_cpl = "cpl" in header_row
-        
-        # Iterate over rows starting from the second row
         counter = 0
-        for row in sheet.iter_rows(min_row=2, values_only=True):
-            # Extract code and label values
-            code, label = row[code_index], row[label_index]
-            
-            if code and label is not None:
-                uid = treat_code(code)
-                if category:
-                    json_content = {
-                    "code": code,
-                    "category": category,
-                    "label": label,
-                    "properties": { header_row[i]: row[i] for i in range(len(row)) if i not in {code_index, label_index} and row[i] is not None },
-                    "restrictions": {}
-                }
-                else:
-                    json_content = {
-                    "code": code,
-                    # "category": category,
-                    "label": label,
-                    "properties": { header_row[i]: row[i] for i in range(len(row)) if i not in {code_index, label_index} and row[i] is not None },
-                    "restrictions": {}
-                }
-                
-                if is_cpl:
-                    cpl_index = header_row.index('cpl')
-                    json_content["restrictions"]["cpl"] = bool(row[cpl_index])
-                    
-                    # Remove 'cpl' from 'properties' if it was added mistakenly
-                    if 'cpl' in json_content["properties"]:
-                        del json_content["properties"]["cpl"]
-                # print(uid)
-                json_data[uid] = json_content
-                counter += 1
+        for uid, json_content in sheet_records(sheet, category):
+            json_data[uid] = json_content
+            counter += 1
         
         print(f"{counter} objects created")
         if json_data:
@@ -144,180 +154,251 @@ def extract_data(workbook, sheet_name):
         return None, None
 
 
+# Batch extraction: every sheet of every workbook is a job for a process pool, openpyxl parsing is CPU bound
 
-def extract_cpl(json_data, json_file, workbook):
+def extract_sheet_job(job):
+    file_name, sheet_name, category = job
+    source = f"{file_name}:{sheet_name}"
     try:
+        workbook = openpyxl.load_workbook(file_name, read_only=True)
+        try:
+            json_data = {}
+            uids = []
+            for uid, json_content in sheet_records(workbook[sheet_name], category):
+                json_data[uid] = json_content
+                uids.append(uid)
+        finally:
+            workbook.close()
 
-        sheet_name = list_tabs(workbook)
-        sheet = workbook[sheet_name]
-
-        # Get the index of the column where codes are stored
-        code_column_index = int(input("Enter the number of the column where codes are stored: ")) - 1
-        value_column_index = int(input("Enter the number of the column for values: ")) - 1
-
-        # Extract and treat codes
-        cpl_object = {}
-        for row in sheet.iter_rows(min_row=2, min_col=code_column_index + 1, max_col=value_column_index + 1, values_only=True):
-            code_value = row[0]
-            cpl_value = row[value_column_index]
-            if code_value:
-                treated_code = treat_code(str(code_value))
-                cpl_object[treated_code] = cpl_value.lower()
-
-        # Compare extracted CPL data with JSON data
+        # Named after workbook and sheet, so equal sheet names from different vendors do not collide
+        output_file = None
         if json_data:
-            changes_count = 0
-            for code, value in cpl_object.items():
-                if code in json_data:
-                    if cpl_object[code] == "acceptable":
-                        json_data[code]["restrictions"]["cpl"] = False
-                        changes_count += 1
-                    else:
-                        json_data[code]["restrictions"]["cpl"] = True
-                        changes_count += 1
-
-        print(f"Changes made: {changes_count}")
-
-        if json_data and json_file:
-            with open(json_file, 'w') as json_file:
-                json.dump(json_data, json_file, indent=2)
-                print(f"Updated JSON data written to {json_file}")
+            output_file = index_file_name(f"{os.path.splitext(os.path.basename(file_name))[0]} {sheet_name}")
+            save_index(json_data, output_file)
+        return source, output_file, uids, None
 
     except Exception as e:
-        print(f"Error occurred while extracting and processing data: {e}")
+        return source, None, [], str(e)
 
+def batch_extract(file_names, category, workers=None):
+    try:
+        jobs = []
+        for file_name in file_names:
+            workbook = open_workbook(file_name)
+            if workbook:
+                jobs.extend((file_name, sheet_name, category) for sheet_name in workbook.sheetnames)
+                workbook.close()
 
+        if not jobs:
+            print("No sheets to extract.")
+            return None
 
+        workers = min(workers or os.cpu_count() or 1, len(jobs))
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(extract_sheet_job, jobs))
 
+        uid_sources = {}
+        for source, output_file, uids, error in results:
+            if error:
+                print(f"Skipped {source}: {error}")
+                continue
+            print(f"{source}: {len(uids)} objects written to {output_file}")
+            for uid in uids:
+                uid_sources.setdefault(uid, []).append(source)
 
-# routines for JSON
+        # A uid listed twice for one source is a duplicate inside that sheet
+        collisions = {uid: sources for uid, sources in uid_sources.items() if len(sources) > 1}
+        report_file = f"uid_collisions_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+        with open(report_file, 'w') as file:
+            json.dump(collisions, file, indent=2)
+        print(f"{len(collisions)} uid collisions across {len(jobs)} sheets written to {report_file}")
 
+        return collisions
 
-# merge ops
+    except Exception as e:
+        print(f"Error occurred while extracting workbooks: {e}")
+        return None
 
-def json_merge_ops(data, filename):
-    
+
+# Streaming variant: one JSON line per record, nothing but the current row kept in memory
+
+def extract_data_stream(workbook, sheet_name):
+    file_name = index_file_name(sheet_name, '.jsonl')
     try:
+        category = input("Category for the Object: ")
+        sheet = workbook[sheet_name]
+
+        # Seen uids go to a temporary on-disk database instead of a set that grows with the sheet
+        seen = sqlite3.connect('')
+        seen.execute("CREATE TABLE uids (uid TEXT PRIMARY KEY)")
+
+        # An existing store for this index gets the rows too, in bounded batches
+        store_file = store_file_name(file_name)
+        store = open_store(store_file) if os.path.exists(store_file) else None
+        batch = []
+        updated = 0
+
         counter = 0
-        
-        for key, value in data.items():
-            # print(key)
-            if "properties" in value:
+        duplicates = 0
+        with open(file_name, 'w') as json_file:
+            for uid, json_content in sheet_records(sheet, category):
+                try:
+                    seen.execute("INSERT INTO uids VALUES (?)", (uid,))
+                except sqlite3.IntegrityError:
+                    # Kept in the file like extract_data keeps it in the dict: the last one wins on load
+                    duplicates += 1
+                    print(f"Duplicate uid: {uid} ({json_content['code']})")
+
+                json_file.write(json.dumps({uid: json_content}) + "\n")
                 counter += 1
-                # print(value)
-                properties = value["properties"]
-                # print(properties)
-                ongoing = properties.get("ongoing", False)
-                completed = properties.get("completed", False)
-                operations = "none"
-                
-                if ongoing and completed:
-                    operations = "both"
-                elif ongoing:
-                    operations = "ongoing"
-                elif completed:
-                    operations = "completed"
-
-                # print(operations)
-                
-                updated_properties = {}
-                for up_key, up_value in properties.items():
-                    if up_key == "ongoing":
-                        updated_properties["operations"] = operations
-                    updated_properties[up_key] = up_value
-                
-                value["properties"] = updated_properties
-                
-                # print(updated_properties)
-        
-        print(f"{counter} objects updated")
 
-        # clean the old keys
-        remove_ongoing_completed_keys(data)
-        
-        with open(filename, 'w') as filename:
-            json.dump(data, filename, indent=2)
-        
-        return data
-        
+                if store:
+                    batch.append((uid, json_content))
+                    if len(batch) >= STORE_BATCH_SIZE:
+                        updated += upsert_records(store, batch)
+                        batch = []
+        seen.close()
+
+        if store:
+            updated += upsert_records(store, batch)
+            store.close()
+            print(f"{updated} records updated in {store_file}")
+
+        print(f"{counter} objects written to {file_name}, {duplicates} duplicate uids")
+        return file_name
+
     except Exception as e:
-        print(f"Error occurred while merging JSON file: {e}")
+        print(f"Error occurred while extracting data: {e}")
         return None
 
 
-# remove ongoing completed
 
+# CPL reconciliation: CPL rows from any number of sheets or CSV files are hashed by uid and
+# joined against the index. Only records whose cpl restriction changes are written back, see save_index
 
-def remove_ongoing_completed_keys(data):
-    for key, value in data.items():
-        if 'properties' in value:
-            properties = value['properties']
-            if 'ongoing' in properties:
-                del properties['ongoing']
-            if 'completed' in properties:
-                del properties['completed']
+def cpl_rows(rows, code_column_index, value_column_index):
+    for row in rows:
+        if len(row) <= max(code_column_index, value_column_index):
+            continue
+        code_value, cpl_value = row[code_column_index], row[value_column_index]
+        if code_value and cpl_value is not None:
+            yield treat_code(code_value), str(cpl_value).strip().lower() != "acceptable"
 
+def ask_cpl_columns():
+    code_column_index = int(input("Enter the number of the column where codes are stored: ")) - 1
+    value_column_index = int(input("Enter the number of the column for values: ")) - 1
+    return code_column_index, value_column_index
 
+def sheet_cpl_rows(workbook, sheet_name, code_column_index, value_column_index):
+    sheet = workbook[sheet_name]
+    # Rows start at column A so both indices stay absolute
+    rows = sheet.iter_rows(min_row=2, max_col=max(code_column_index, value_column_index) + 1, values_only=True)
+    return cpl_rows(rows, code_column_index, value_column_index)
 
+def csv_cpl_rows(file_name, code_column_index, value_column_index):
+    with open(file_name, newline='') as csv_file:
+        rows = csv.reader(csv_file)
+        next(rows, None)
+        yield from cpl_rows(rows, code_column_index, value_column_index)
 
-# create aggregate
+def select_cpl_sources(workbook):
+    sources = []
+    while True:
+        source_type = input("CPL source: 1. Workbook sheet 2. CSV file (Enter when done): ").strip()
+        if not source_type:
+            return sources
+        if source_type == "1" and workbook:
+            sheet_name = list_tabs(workbook)
+            if sheet_name:
+                sources.append((sheet_name, sheet_cpl_rows(workbook, sheet_name, *ask_cpl_columns())))
+        elif source_type == "2":
+            csv_file = list_files('csv')
+            if csv_file:
+                sources.append((csv_file, csv_cpl_rows(csv_file, *ask_cpl_columns())))
+        else:
+            print("Invalid source.")
+
+def reconcile_cpl(json_data, sources):
+    cpl_values = {}
+    conflicting = set()
+    for source_name, rows in sources:
+        for uid, cpl in rows:
+            if cpl_values.setdefault(uid, cpl) != cpl:
+                conflicting.add(uid)
+
+    # Conflicting codes are reported and left as they are
+    matched, unmatched, changed = [], [], []
+    for uid, cpl in cpl_values.items():
+        if uid in conflicting:
+            continue
+        json_content = json_data.get(uid)
+        if json_content is None:
+            unmatched.append(uid)
+            continue
+        matched.append(uid)
+        restrictions = json_content.setdefault("restrictions", {})
+        if restrictions.get("cpl") != cpl:
+            restrictions["cpl"] = cpl
+            changed.append(uid)
+
+    return {"matched": matched, "unmatched": unmatched, "conflicting": sorted(conflicting), "changed": changed}
 
-def json_update_aggregate(data, filename):
-    
+def extract_cpl(json_data, json_file, workbook):
     try:
-        counter = 0
-        
-        for key, value in data.items():
-            # print(key)
-            if "label" in value:
-                label = value['label'].lower()
-                project = "project" in label
-                location = "location" in label
-                
-                properties = value.get("properties", {})
-                
-                if project and location:
-                    properties["agg"] = "both"
-                elif project:
-                    properties["agg"] = "project"
-                elif location:
-                    properties["agg"] = "location"
-                else:
-                    properties["agg"] = "none"
-                
-                value['properties'] = properties
-                counter += 1
-        
-        print(f"{counter} objects updated")
+        sources = select_cpl_sources(workbook)
+        if not sources:
+            print("No CPL sources selected.")
+            return None
+
+        report = reconcile_cpl(json_data, sources)
+        changed = report["changed"]
+
+        print(f"Matched: {len(report['matched'])}, unmatched: {len(report['unmatched'])}, "
+              f"conflicting: {len(report['conflicting'])}")
+        print(f"Changes made: {len(changed)}")
+
+        report_file = f"cpl_report_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+        with open(report_file, 'w') as file:
+            json.dump({"sources": [source_name for source_name, rows in sources], **report}, file, indent=2)
+        print(f"CPL report written to {report_file}")
+
+        if changed:
+            save_index(json_data, json_file, changed)
+
+        return report
 
-        with open(filename, 'w') as filename:
-            json.dump(data, filename, indent=2)
-        
-        return data
-        
     except Exception as e:
-        print(f"Error occurred while updating JSON file: {e}")
+        print(f"Error occurred while extracting and processing data: {e}")
         return None
-    
 
-# fix blanket AI
 
-def json_update_blanket(data, filename):
+
+
+
+# routines for JSON
+
+
+# Each transform is a step over one record returning how many objects it updated, so any
+# number of them run in a single pass over the index followed by a single write
+
+def run_transforms(data, filename, steps):
     try:
-        counter = 0
-        
+        counters = {name: 0 for name in steps}
+        changed = []
+
         for key, value in data.items():
-            label = value.get("label", "").lower()
-            if ('blanket additional' in label or 'blanket ai' in label) and value.get("properties"):
-                properties = value["properties"]
-                if "blanket" in properties and not properties["blanket"]:
-                    properties["blanket"] = True
-                    counter += 1
-        
-        print(f"{counter} objects updated")
-        
-        with open(filename, 'w') as filename:
-            json.dump(data, filename, indent=2)
+            updated = 0
+            for name in steps:
+                step_updated = TRANSFORM_STEPS[name](value)
+                counters[name] += step_updated
+                updated += step_updated
+            if updated:
+                changed.append(key)
+
+        for name in steps:
+            print(f"{name}: {counters[name]} objects updated")
+
+        save_index(data, filename, changed)
         
         return data
         
@@ -326,85 +407,152 @@ def json_update_blanket(data, filename):
         return None
 
 
+# merge ops
+
+def merge_ops_step(value):
+    if "properties" not in value:
+        return 0
+
+    properties = value["properties"]
+    ongoing = properties.get("ongoing", False)
+    completed = properties.get("completed", False)
+    operations = "none"
+    
+    if ongoing and completed:
+        operations = "both"
+    elif ongoing:
+        operations = "ongoing"
+    elif completed:
+        operations = "completed"
+
+    # operations takes the place of ongoing, completed goes away with it
+    updated_properties = {}
+    for up_key, up_value in properties.items():
+        if up_key == "ongoing":
+            updated_properties["operations"] = operations
+        elif up_key != "completed":
+            updated_properties[up_key] = up_value
+    
+    value["properties"] = updated_properties
+    return 1
+
+def json_merge_ops(data, filename):
+    return run_transforms(data, filename, ("merge_ops",))
+
+
+# create aggregate
+
+def aggregate_step(value):
+    if "label" not in value:
+        return 0
+
+    label = value['label'].lower()
+    project = "project" in label
+    location = "location" in label
+    
+    properties = value.get("properties", {})
+    
+    if project and location:
+        properties["agg"] = "both"
+    elif project:
+        properties["agg"] = "project"
+    elif location:
+        properties["agg"] = "location"
+    else:
+        properties["agg"] = "none"
+    
+    value['properties'] = properties
+    return 1
+
+def json_update_aggregate(data, filename):
+    return run_transforms(data, filename, ("aggregate",))
+    
+
+# fix blanket AI
+
+def blanket_step(value):
+    label = value.get("label", "").lower()
+    if ('blanket additional' in label or 'blanket ai' in label) and value.get("properties"):
+        properties = value["properties"]
+        if "blanket" in properties and not properties["blanket"]:
+            properties["blanket"] = True
+            return 1
+    return 0
+
+def json_update_blanket(data, filename):
+    return run_transforms(data, filename, ("blanket",))
+
+
 # extract x days notice of cancellation
 
+NOTICE_DAYS = re.compile(r'(\d+)\s*days')
+
+def notice_step(value):
+    label = value.get("label", "").lower()
+    properties = value.get('properties', {})
+    # Search text in the label to validate update
+    match = NOTICE_DAYS.search(label)
+    if match:
+        properties['noc'] = match.group(1)
+    elif 'days' in label:
+        # Check if "days" is present but no number is found before it
+        properties['noc'] = 'invalid'
+    else:
+        properties['noc'] = 'none'
+    return 1
+
 def extract_notice(data, filename):
-    try:
-        counter = 0
-        
-        for key, value in data.items():
-            label = value.get("label", "").lower()
-            # Search text in the label to validate update
-            match = re.search(r'(\d+)\s*days', label)
-            if match:
-                days = match.group(1)
-                properties = value.get('properties', {})
-                properties['noc'] = days
-                counter += 1
-            elif 'days' in label:
-                # Check if "days" is present but no number is found before it
-                properties = value.get('properties', {})
-                properties['noc'] = 'invalid'
-                counter += 1
-            else:
-                properties = value.get('properties', {})
-                properties['noc'] = 'none'
-                counter += 1
-            
-        print(f"{counter} objects updated")
-        
-        with open(filename, 'w') as file:
-            json.dump(data, file, indent=2)
-        
-        return data
-        
-    except Exception as e:
-        print(f"Error occurred while updating JSON file: {e}")
-        return None
+    return run_transforms(data, filename, ("notice",))
 
 
 
 # remove none values
 
+def clear_none_step(value):
+    if "properties" not in value:
+        return 0
 
+    properties = value["properties"]
+    keys_to_remove = [key for key, item in properties.items() if item == "none"]
+    for key in keys_to_remove:
+        del properties[key]
+    return len(keys_to_remove)
 
 def clear_none(data, filename):
-    try:
-        counter = 0
-        
-        for key, value in data.items():
-            label = value.get("label", "").lower()
-            # Search text in the label to validate update
-            if "properties" in value:
-                properties = value["properties"]
-                keys_to_remove = [key for key, value in properties.items() if value == "none"]
-                for key in keys_to_remove:
-                    del properties[key]
-                    counter += 1
-            
-        print(f"{counter} objects updated")
-        
-        with open(filename, 'w') as file:
-            json.dump(data, file, indent=2)
-        
-        return data
-        
-    except Exception as e:
-        print(f"Error occurred while updating JSON file: {e}")
-        return None
+    return run_transforms(data, filename, ("clear_none",))
+
+
+TRANSFORM_STEPS = {
+    "merge_ops": merge_ops_step,
+    "aggregate": aggregate_step,
+    "blanket": blanket_step,
+    "notice": notice_step,
+    "clear_none": clear_none_step,
+}
 
 
 
 # json operations
 
 
+def index_file_name(sheet_name, extension='.json'):
+    return f"index_{sheet_name.lower().replace(' ', '_')}{extension}"
+
+def dump_json(json_data, file_name):
+    # .jsonl files hold one {uid: record} object per line, anything else is one indented document
+    with open(file_name, "w") as json_file:
+        if file_name.endswith('.jsonl'):
+            for uid, record in json_data.items():
+                json_file.write(json.dumps({uid: record}) + "\n")
+        else:
+            json.dump(json_data, json_file, indent=2)
+
 def write_json(json_data, sheet_name):
     try:
         # Construct the file name
-        file_name = f"index_{sheet_name.lower().replace(' ', '_')}.json"
+        file_name = index_file_name(sheet_name)
         
-        with open(file_name, "w") as json_file:
-            json.dump(json_data, json_file, indent=2)
+        save_index(json_data, file_name)
 
         print(f"JSON data has been written to {file_name}")
         
@@ -419,7 +567,13 @@ def write_json(json_data, sheet_name):
 def load_json(file_name):
     try:
         with open(file_name, 'r') as json_file:
-            json_data = json.load(json_file)
+            if file_name.endswith('.jsonl'):
+                json_data = {}
+                for line in json_file:
+                    if line.strip():
+                        json_data.update(json.loads(line))
+            else:
+                json_data = json.load(json_file)
         return json_data
 
     except Exception as e:
@@ -428,6 +582,121 @@ def load_json(file_name):
 
 
 
+# record store: one row per uid in SQLite, next to the JSON index it was imported from
+
+# Index files whose store has updates the JSON file does not have yet
+pending_exports = set()
+
+# Records upserted per transaction when a stream is written to a store
+STORE_BATCH_SIZE = 1000
+
+def store_file_name(json_file):
+    return os.path.splitext(json_file)[0] + ".db"
+
+def open_store(file_name):
+    store = sqlite3.connect(file_name)
+    store.execute("CREATE TABLE IF NOT EXISTS records (uid TEXT PRIMARY KEY, category TEXT, data TEXT NOT NULL)")
+    store.execute("CREATE INDEX IF NOT EXISTS records_category ON records (category)")
+    return store
+
+def upsert_records(store, records):
+    # One transaction per batch, rows whose data did not change are left alone
+    before = store.total_changes
+    with store:
+        store.executemany(
+            "INSERT INTO records (uid, category, data) VALUES (?, ?, ?) "
+            "ON CONFLICT (uid) DO UPDATE SET category = excluded.category, data = excluded.data "
+            "WHERE records.data != excluded.data",
+            ((uid, record.get("category"), json.dumps(record)) for uid, record in records))
+    return store.total_changes - before
+
+def save_index(json_data, json_file, uids=None):
+    # Once an index has a store the store is the primary copy: updates of some uids only touch their
+    # rows and the JSON file is refreshed on export or when the session ends. A whole new index
+    # (uids None) is written to both
+    store_file = store_file_name(json_file)
+    if not os.path.exists(store_file):
+        dump_json(json_data, json_file)
+        return
+
+    if uids is None:
+        dump_json(json_data, json_file)
+        records = json_data.items()
+    else:
+        records = ((uid, json_data[uid]) for uid in uids)
+
+    store = open_store(store_file)
+    updated = upsert_records(store, records)
+    store.close()
+    print(f"{updated} records updated in {store_file}")
+    if uids is not None and updated:
+        pending_exports.add(json_file)
+
+def load_store(json_file):
+    store = open_store(store_file_name(json_file))
+    json_data = {uid: json.loads(data) for uid, data in store.execute("SELECT uid, data FROM records ORDER BY rowid")}
+    store.close()
+    return json_data
+
+def load_index(json_file):
+    # The store wins over a JSON file that may not have been exported yet
+    if os.path.exists(store_file_name(json_file)):
+        return load_store(json_file)
+    return load_json(json_file)
+
+def get_record(store, uid):
+    row = store.execute("SELECT data FROM records WHERE uid = ?", (uid,)).fetchone()
+    return json.loads(row[0]) if row else None
+
+def records_by_category(store, category):
+    for uid, data in store.execute("SELECT uid, data FROM records WHERE category = ? ORDER BY rowid", (category,)):
+        yield uid, json.loads(data)
+
+def import_store(json_data, json_file):
+    try:
+        store_file = store_file_name(json_file)
+        store = open_store(store_file)
+        updated = upsert_records(store, json_data.items())
+        store.close()
+        print(f"{updated} records imported or updated in {store_file}")
+        return store_file
+
+    except Exception as e:
+        print(f"Error occurred while importing into the record store: {e}")
+        return None
+
+def export_store(json_file):
+    try:
+        json_data = load_store(json_file)
+        dump_json(json_data, json_file)
+        pending_exports.discard(json_file)
+        print(f"{len(json_data)} records exported to {json_file}")
+        return json_data
+
+    except Exception as e:
+        print(f"Error occurred while exporting the record store: {e}")
+        return None
+
+def lookup_store(json_file):
+    try:
+        store = open_store(store_file_name(json_file))
+        query = input("uid or category to look up: ").strip()
+        record = get_record(store, treat_code(query))
+        if record:
+            print(json.dumps(record, indent=2))
+        else:
+            counter = 0
+            for uid, record in records_by_category(store, query):
+                print(f"{uid}: {record.get('label')}")
+                counter += 1
+            print(f"{counter} records in category '{query}'")
+        store.close()
+
+    except Exception as e:
+        print(f"Error occurred while reading the record store: {e}")
+
+
+
 
 
 
@@ -440,7 +709,13 @@ def show_menu():
     print("5. Fix Operations & Aggregate")
     print("6. Fix Blanket AI")
     print("7. Fix NoC days")
+    print("8. Stream Index to JSONL")
     print("9. Clear None")
+    print("10. Run All Fixes (single pass)")
+    print("11. Import JSON to Store")
+    print("12. Export Store to JSON")
+    print("13. Lookup in Store")
+    print("14. Batch Extract All Workbooks")
     print("0. Quit")
 
 def main():
@@ -472,23 +747,22 @@ def main():
                 print("Missing references.")
 
         elif choice == "3":
-            if json_data and json_file and workbook:
+            if json_data and json_file:
                 extract_cpl(json_data, json_file, workbook)
             else:
                 print("Missing references.")
             # json_data = extract_cpl(json_data, json_file, workbook)
 
         elif choice == "4":
-            json_file = list_files('json')
+            json_file = list_files(('json', 'jsonl'))
             if json_file:
-                json_data = load_json(json_file)
+                json_data = load_index(json_file)
             else:
                 print("No JSON data.")
 
         elif choice == "5":
             if json_data and json_file:
-                json_data = json_merge_ops(json_data, json_file)
-                json_data = json_update_aggregate(json_data, json_file)
+                json_data = run_transforms(json_data, json_file, ("merge_ops", "aggregate"))
             else:
                 print("No JSON data")
 
@@ -506,14 +780,57 @@ def main():
                 print("No JSON data")
                 
         
+        elif choice == "8":
+            if workbook and excel_sheet:
+                # Not loaded back, the point is to keep the index out of memory; use 4 to load it
+                json_file = extract_data_stream(workbook, excel_sheet)
+                json_data = None
+            else:
+                print("Missing references.")
+
         elif choice == "9":
             if json_data and json_file:
                 json_data = clear_none(json_data, json_file)
             else:
                 print("No JSON data")
 
+        elif choice == "10":
+            if json_data and json_file:
+                json_data = run_transforms(json_data, json_file, tuple(TRANSFORM_STEPS))
+            else:
+                print("No JSON data")
+
+        elif choice == "11":
+            if json_data and json_file:
+                import_store(json_data, json_file)
+            else:
+                print("No JSON data")
+
+        elif choice == "12":
+            if json_file and os.path.exists(store_file_name(json_file)):
+                json_data = export_store(json_file)
+            else:
+                print("No record store")
+
+        elif choice == "13":
+            if json_file and os.path.exists(store_file_name(json_file)):
+                lookup_store(json_file)
+            else:
+                print("No record store")
+
+        elif choice == "14":
+            excel_files = sorted(file for file in os.listdir() if file.endswith("xlsx"))
+            if excel_files:
+                category = input("Category for the Objects: ")
+                workers = input(f"Number of workers (Enter for {os.cpu_count() or 1}): ").strip()
+                batch_extract(excel_files, category, int(workers) if workers.isdigit() else None)
+            else:
+                print("No Excel data.")
+
         elif choice == "0":
             print("Exiting...")
+            for pending_file in sorted(pending_exports):
+                export_store(pending_file)
             if workbook:
                 workbook.close()
             break
@@ -1,22 +1,302 @@
 # xipspace
 
+import argparse
+import cProfile
+import csv
+import hashlib
+import importlib
+import io
+import json
 import os
+import queue
 import re
+import socket
+import struct
 import sys
+import threading
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache, partial, wraps
 from datetime import datetime
 
-import cv2
-import numpy as np
-from PyPDF2 import PdfReader, PdfWriter
-from PIL import Image
-import fitz
+# Heavy backends are imported on first use by the stage that needs them, see load_backends
+cv2 = None
+np = None
+Image = None
+fitz = None
+
+BACKENDS = {
+    'cv2': ('cv2', None),
+    'np': ('numpy', None),
+    'Image': ('PIL.Image', None),
+    'fitz': ('fitz', None),
+}
+IMAGE_BACKENDS = ('cv2', 'np', 'Image', 'fitz')
+
+# Stage name -> (function, backends it needs)
+STAGES = {}
+
+DEFAULT_WORKERS = os.cpu_count() or 1
+MAX_OPEN_DOCUMENTS = 16
+
+DEFAULT_SETTINGS = {
+    'dpi': 200,
+    'max_width': 1500,
+    'quality': 35,
+    # Render at full DPI and LANCZOS downscale to max_width instead of rendering at the target size
+    'supersample': False,
+    # 'rgb', 'gray' (single channel end to end) or 'bilevel' (1-bit, Flate compressed)
+    'color_mode': 'rgb',
+    # Rows per strip for bounded-memory rendering and filtering, 0 renders the whole page at once
+    'tile_height': 0,
+    # Upper bound on the assembled page in tiled mode, the zoom is lowered to fit
+    'max_pixels': 50_000_000,
+    # Pages in flight between the render, filter, encode and write stages, 0 runs them inline
+    'pipeline_depth': 4,
+    # Reuse treated pages from CACHE_FOLDER, evicting least recently used entries above cache_size bytes
+    'cache': True,
+    'cache_size': 2 * 1024 ** 3,
+    # Copy born-digital pages through untouched and only treat scanned ones
+    'passthrough': True,
+    # Ordered filter_image steps: names from FILTER_STEPS, or (name, {param: value}) to override defaults
+    'filters': ('gaussian', 'bilateral', 'sharpen'),
+    # OpenCV threads per pool worker, 0 shares the cores out between the workers
+    'cv2_threads': 0,
+}
+
+# Share of the page covered by images above which a page counts as scanned, with or without text
+SCAN_COVERAGE = 0.9
+# Lower coverage still counts as scanned when the page carries no text
+IMAGE_COVERAGE = 0.5
+
+CACHE_FOLDER = '.pdf-lab-cache'
+# Settings that change the treated output and therefore belong in the cache key
+CACHE_KEYS = ('dpi', 'max_width', 'quality', 'supersample', 'color_mode', 'tile_height', 'max_pixels', 'filters')
+CACHE_HEADER = struct.Struct('<8sII')
+
+# Shared intake queue: claimed, done and failed documents live under this folder inside the intake
+QUEUE_FOLDER = '.pdf-lab-queue'
+QUEUE_FOLDERS = ('claimed', 'done', 'failed', 'attempts')
+# A claim whose lease was not refreshed for this long belongs to a dead worker and goes back to the intake
+LEASE_SECONDS = 120
+MAX_ATTEMPTS = 3
+
+# Pages merged in memory before they are flushed to the partial output file
+MERGE_PAGES_PER_SAVE = 200
+
+# filter_image steps and their default parameters
+FILTER_STEPS = {
+    'gaussian': {'ksize': 5, 'sigma': 0},
+    'bilateral': {'d': 5, 'sigma_color': 10, 'sigma_space': 10},
+    'sharpen': {'strength': 1},
+}
+# Named chains, fast skips the bilateral pass which clean scans do not need
+FILTER_PRESETS = {
+    'default': ('gaussian', 'bilateral', 'sharpen'),
+    'fast': ('gaussian', 'sharpen'),
+    'none': (),
+}
+
+EXIT_OK = 0
+EXIT_FAILED = 1
+EXIT_USAGE = 2
+
+REPORT_FIELDS = ('document', 'page', 'stage', 'wall', 'cpu', 'pixels', 'bytes_read', 'bytes_written', 'peak_rss_mb')
+
+# Folder listings younger than this are rescanned on the next lookup, network shares round mtimes
+FOLDER_SETTLE_SECONDS = 2
+
+# Open documents shared by the render stages, least recently used first
+open_documents = {}
+
+# Intermediate filter_image frames, reused per thread while the page size stays the same
+filter_buffers = threading.local()
+
+# Absolute folder path -> scandir listing, reused while the folder mtime is unchanged, see index_folder
+folder_index = {}
+
+# Run report state: stage records while a report is active, the document and page each thread works on
+stage_records = None
+worker_records = False
+profiler = None
+page_context = threading.local()
+
+def load_backends(*names):
+    for name in names:
+        if globals()[name] is None:
+            module_name, attribute = BACKENDS[name]
+            module = importlib.import_module(module_name)
+            globals()[name] = getattr(module, attribute) if attribute else module
+
+def stage(name, *backends):
+    def register(function):
+        @wraps(function)
+        def run(*args, **kwargs):
+            load_backends(*backends)
+            return function(*args, **kwargs)
+        STAGES[name] = (run, backends)
+        return run
+    return register
 
 def natural_sort_key(s):
     return [int(text) if text.isdigit() else text.lower()
             for text in re.split(r'(\d+)', s)]
 
 def get_files_with_extension(folder, extension):
-    return [f for f in os.listdir(folder) if f.lower().endswith(extension)]
+    return list(index_folder(folder)['files'].get(extension, ()))
+
+def index_folder(folder):
+    path = os.path.abspath(folder)
+    mtime = os.stat(path).st_mtime_ns
+    entry = folder_index.get(path)
+    if entry is not None and entry['mtime'] == mtime and entry['settled']:
+        return entry
+
+    files = {}
+    folders = []
+    with os.scandir(path) as entries:
+        for item in entries:
+            if item.is_dir():
+                folders.append(item.path)
+            elif item.is_file():
+                files.setdefault(os.path.splitext(item.name)[1].lower(), []).append(item.name)
+
+    # A change within the same mtime tick would go unnoticed, so a fresh listing is not trusted yet
+    settled = time.time() - mtime / 1e9 > FOLDER_SETTLE_SECONDS
+    entry = {'mtime': mtime, 'settled': settled, 'files': files, 'folders': folders}
+    entry['pdf_count'] = len(files.get('.pdf', ()))
+    entry['jpg_count'] = len(files.get('.jpg', ()))
+    entry['state'] = folder_state(path, files)
+    folder_index[path] = entry
+    return entry
+
+def folder_state(path, files):
+    pdf_files = files.get('.pdf', [])
+    jpg_files = files.get('.jpg', [])
+    folder_name = os.path.basename(path)
+
+    if f"{folder_name}_merged.pdf" in pdf_files or f"{folder_name}.pdf" in pdf_files:
+        return 'merged'
+    if jpg_files:
+        return 'treated' if all(f.startswith('treated_') for f in jpg_files) else 'images'
+    if pdf_files:
+        return 'converted' if all(f.startswith('treated_') for f in pdf_files) else 'split'
+    return 'empty'
+
+def invalidate_folder(*folders):
+    for folder in folders:
+        folder_index.pop(os.path.abspath(folder), None)
+
+def acquire_document(pdf_path):
+    doc = open_documents.pop(pdf_path, None)
+    if doc is None:
+        if len(open_documents) >= MAX_OPEN_DOCUMENTS:
+            release_document(next(iter(open_documents)))
+        doc = fitz.open(pdf_path)
+    open_documents[pdf_path] = doc
+    return doc
+
+def release_document(pdf_path):
+    doc = open_documents.pop(pdf_path, None)
+    if doc is not None:
+        doc.close()
+
+def release_documents():
+    for pdf_path in list(open_documents):
+        release_document(pdf_path)
+
+def iter_pages(pdf_path):
+    doc = acquire_document(pdf_path)
+    try:
+        for page_num in range(doc.page_count):
+            yield page_num, doc[page_num]
+    finally:
+        release_document(pdf_path)
+
+def set_page_context(document, page_num=None):
+    page_context.document = document
+    page_context.page = page_num
+
+@contextmanager
+def measure_stage(stage, **counters):
+    if stage_records is None:
+        yield {}
+        return
+
+    record = {'document': getattr(page_context, 'document', None), 'page': getattr(page_context, 'page', None),
+              'stage': stage, 'pixels': 0, 'bytes_read': 0, 'bytes_written': 0, **counters}
+    # Thread CPU time, so overlapped pipeline stages do not count each other
+    start_wall, start_cpu = time.perf_counter(), time.thread_time()
+    try:
+        yield record
+    finally:
+        record['wall'] = time.perf_counter() - start_wall
+        record['cpu'] = time.thread_time() - start_cpu
+        record['peak_rss_mb'] = peak_rss_mb()
+        stage_records.append(record)
+
+def peak_rss_mb():
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+def take_records():
+    if stage_records is None:
+        return []
+    records = stage_records[:]
+    del stage_records[:len(records)]
+    return records
+
+def start_report(profile=False):
+    global stage_records, profiler
+    stage_records = []
+    if profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+def stop_report(report_path):
+    global stage_records, profiler
+    if profiler:
+        profiler.disable()
+        profiler.dump_stats(os.path.splitext(report_path)[0] + '.prof')
+        profiler = None
+
+    records, stage_records = stage_records or [], None
+    write_report(records, report_path)
+
+def write_report(records, report_path):
+    documents = {}
+    for record in records:
+        summary = documents.setdefault(record['document'] or '', {}).setdefault(record['stage'], {
+            'count': 0, 'wall': 0, 'cpu': 0, 'pixels': 0, 'bytes_read': 0, 'bytes_written': 0, 'peak_rss_mb': 0})
+        summary['count'] += 1
+        for field in ('wall', 'cpu', 'pixels', 'bytes_read', 'bytes_written'):
+            summary[field] += record[field]
+        summary['peak_rss_mb'] = max(summary['peak_rss_mb'], record['peak_rss_mb'] or 0)
+
+    with open(report_path, 'w') as report_file:
+        json.dump({'documents': documents, 'records': records}, report_file, indent=2)
+
+    csv_path = os.path.splitext(report_path)[0] + '.csv'
+    with open(csv_path, 'w', newline='') as csv_file:
+        writer = csv.DictWriter(csv_file, fieldnames=REPORT_FIELDS, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(records)
+
+    print(f"Run report written to {report_path} and {csv_path}")
 
 def find_valid_pdfs():
     pdf_files = get_files_with_extension('.', '.pdf')
@@ -44,216 +324,1155 @@ def generate_default_output_folder(input_pdf):
     input_filename = transform_filename(input_filename)
     return os.path.join(os.path.dirname(input_pdf), f"{timestamp}_{input_filename}")
 
-def split_pdf(input_pdf, output_folder):
-    pdf_reader = PdfReader(input_pdf)
+@stage('split', 'fitz')
+def split_pdf(input_pdf, output_folder, pages_per_file=1, workers=1, garbage=3):
     input_filename = os.path.splitext(os.path.basename(input_pdf))[0]
     input_filename = transform_filename(input_filename)
     os.makedirs(output_folder, exist_ok=True)
 
-    num_pages = len(pdf_reader.pages)
+    num_pages = acquire_document(input_pdf).page_count
     print(f"Processing '{input_filename}' with {num_pages} pages.")
 
     processed_folders = []
+    jobs = []
 
-    for page_num, page in enumerate(pdf_reader.pages, start=1):
-        output_filename = f'{input_filename}_page_{page_num}.pdf'
-        output_path = os.path.join(output_folder, output_filename)
-        write_page_to_pdf(page, pdf_reader.metadata, output_path)
+    for first_page in range(0, num_pages, pages_per_file):
+        last_page = min(num_pages, first_page + pages_per_file) - 1
+        if first_page == last_page:
+            output_filename = f'{input_filename}_page_{first_page + 1}.pdf'
+        else:
+            output_filename = f'{input_filename}_pages_{first_page + 1}-{last_page + 1}.pdf'
+        jobs.append((input_pdf, first_page, last_page, os.path.join(output_folder, output_filename)))
+
+    job_runner = partial(write_chunk_job, garbage=garbage)
+
+    # The source is parsed once per process and every chunk is grafted from that handle
+    if workers > 1 and len(jobs) > 1:
+        release_documents()
+        chunksize = max(1, len(jobs) // (workers * 4))
+        # Split workers only need fitz
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                 initargs=(stage_records is not None, 1, ('fitz',))) as executor:
+            results = list(executor.map(job_runner, jobs, chunksize=chunksize))
+    else:
+        results = [job_runner(job) for job in jobs]
+    release_document(input_pdf)
+    invalidate_folder(output_folder, os.path.dirname(os.path.abspath(output_folder)))
+
+    failed = 0
+    for (_, first_page, last_page, output_path), error, records in results:
+        if records and stage_records is not None:
+            stage_records.extend(records)
+        if error:
+            failed += 1
+            print(f"Error writing pages {first_page + 1}-{last_page + 1} to '{output_path}': {error}")
 
     processed_folders.append(output_folder)
 
-    return processed_folders
+    return processed_folders, failed
 
-def write_page_to_pdf(page, metadata, output_path):
-    pdf_writer = PdfWriter()
-    pdf_writer.add_page(page)
-    pdf_writer.add_metadata(metadata)
+def write_chunk_job(job, garbage=3):
+    input_pdf, first_page, last_page, output_path = job
+    set_page_context(input_pdf, first_page)
+    error = None
 
-    with open(output_path, 'wb') as output_pdf:
-        pdf_writer.write(output_pdf)
+    try:
+        source_doc = acquire_document(input_pdf)
+        metadata = {key: value for key, value in source_doc.metadata.items()
+                    if value and key not in ('format', 'encryption')}
+
+        with measure_stage('split') as record:
+            with fitz.open() as chunk_doc:
+                chunk_doc.insert_pdf(source_doc, from_page=first_page, to_page=last_page)
+                chunk_doc.set_metadata(metadata)
+                copy_custom_info(source_doc, chunk_doc)
+                # garbage=3 merges duplicate objects, 4 also compares stream contents
+                chunk_doc.save(output_path, garbage=garbage, deflate=True)
+            record['bytes_written'] = os.path.getsize(output_path)
+    except Exception as e:
+        error = str(e)
+
+    return job, error, take_records() if worker_records else []
+
+def copy_custom_info(source_doc, target_doc):
+    # set_metadata only knows the standard keys, custom document info entries are copied one by one
+    kind, value = source_doc.xref_get_key(-1, 'Info')
+    if kind != 'xref':
+        return
+    source_xref = int(value.split()[0])
+    standard_keys = {'Title', 'Author', 'Subject', 'Keywords', 'Creator', 'Producer', 'CreationDate', 'ModDate', 'Trapped'}
+    custom_items = []
+    for key in source_doc.xref_get_keys(source_xref):
+        if key in standard_keys:
+            continue
+        kind, value = source_doc.xref_get_key(source_xref, key)
+        # References point into the source file and cannot be carried over
+        if kind == 'xref' or (kind in ('dict', 'array') and re.search(r'\d+ \d+ R', value)):
+            continue
+        custom_items.append((key, fitz.get_pdf_str(value) if kind == 'string' else value))
+    if not custom_items:
+        return
+
+    kind, value = target_doc.xref_get_key(-1, 'Info')
+    if kind == 'xref':
+        target_xref = int(value.split()[0])
+    else:
+        target_xref = target_doc.get_new_xref()
+        target_doc.update_object(target_xref, '<<>>')
+        target_doc.xref_set_key(-1, 'Info', f'{target_xref} 0 R')
+    for key, value in custom_items:
+        target_doc.xref_set_key(target_xref, key, value)
 
+@stage('info')
 def list_folder_info(folders):
     for folder in folders:
-        pdf_files = get_files_with_extension(folder, '.pdf')
-        image_files = get_files_with_extension(folder, '.jpg')
-
-        num_pdfs = len(pdf_files)
-        num_images = len(image_files)
+        entry = index_folder(folder)
+        print(f"Folder: {folder}, PDF Count: {entry['pdf_count']}, Image Count: {entry['jpg_count']}, "
+              f"State: {entry['state']}")
 
-        print(f"Folder: {folder}, PDF Count: {num_pdfs}, Image Count: {num_images}")
 
-
-def extract_pages(pdf_files):
+@stage('extract', 'fitz')
+def extract_pages(pdf_files, pages_per_file=1, workers=1, failed_folders=None):
     processed_folders = []
+    failed = 0
     for pdf_file in pdf_files:
-        processed_folders.extend(split_pdf(pdf_file, generate_default_output_folder(pdf_file)))
+        output_folder = generate_default_output_folder(pdf_file)
+        try:
+            split_folders, split_failed = split_pdf(pdf_file, output_folder, pages_per_file, workers)
+        except Exception as e:
+            print(f"Error splitting '{pdf_file}': {e}")
+            release_document(pdf_file)
+            failed += 1
+            continue
+        processed_folders.extend(split_folders)
+        failed += split_failed
+        # A folder with missing chunks would be treated and merged into an incomplete document
+        if split_failed and failed_folders is not None:
+            failed_folders.extend(split_folders)
     print("Extraction complete.")
-    return processed_folders
+    return processed_folders, failed
 
+@stage('convert_to_image', 'Image', 'fitz')
 def convert_to_image(folders):
     for folder in folders:
         pdf_files = get_files_with_extension(folder, '.pdf')
         for pdf_file in pdf_files:
             pdf_path = os.path.join(folder, pdf_file)
-            doc = fitz.open(pdf_path)
-            for page_num in range(doc.page_count):
-                process_page(folder, pdf_file, page_num, doc)
+            for page_num, page in iter_pages(pdf_path):
+                process_page(folder, pdf_file, page_num, page)
 
-def process_page(folder, pdf_file, page_num, doc):
-    page = doc[page_num]
+def process_page(folder, pdf_file, page_num, page):
     pixmap = page.get_pixmap(matrix=fitz.Matrix(200 / 72, 200 / 72))
     img = Image.frombytes("RGB", [pixmap.width, pixmap.height], pixmap.samples)
     img_path = os.path.join(folder, f"{os.path.splitext(pdf_file)[0]}.jpg")
-    img.save(img_path, 'JPEG')
+    img.save(img_path, 'JPEG', dpi=(200, 200))
+
+@stage('treat', *IMAGE_BACKENDS)
+def treat_images(folders, workers=1, settings=DEFAULT_SETTINGS, failed_folders=None):
+    jobs = []
+    files_to_remove = []
 
-def treat_images(folders):
     for folder in folders:
         pdf_files = get_files_with_extension(folder, '.pdf')
         jpg_files = get_files_with_extension(folder, '.jpg')
-        treated_files = [f for f in jpg_files if f.startswith('treated_')]
+        # Merged output is never a treatment input, so it is neither rasterised nor removed
+        merged_file = f"{os.path.basename(os.path.abspath(folder))}_merged.pdf"
+        pdf_files = [f for f in pdf_files if f != merged_file]
+        treated_files = [f for f in pdf_files + jpg_files if f.startswith('treated_')]
+
+        pdf_files.sort(key=natural_sort_key)
 
         for pdf_file in pdf_files:
+            if pdf_file in treated_files:
+                continue
             pdf_path = os.path.join(folder, pdf_file)
 
-            with fitz.open(pdf_path) as doc:
-                for page_num in range(doc.page_count):
-                    process_image(folder, pdf_file, page_num)
+            page_count = acquire_document(pdf_path).page_count
+            jobs.extend((folder, pdf_file, page_num) for page_num in range(page_count))
 
         for file in pdf_files + jpg_files:
-            file_path = os.path.join(folder, file)
             if file not in treated_files:
-                os.remove(file_path)
-
-def process_image(folder, pdf_file, page_num, quality=35, max_width=1500):
+                files_to_remove.append(os.path.join(folder, file))
+
+    job_runner = partial(process_image_job, settings=settings)
+
+    # Results come back in job order whatever the worker count, so reporting stays deterministic
+    if workers > 1 and len(jobs) > 1:
+        # Handles must not leak into forked workers, each worker opens its own
+        release_documents()
+        chunksize = max(1, len(jobs) // (workers * 4))
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                 initargs=(stage_records is not None, worker_cv2_threads(settings, workers))) as executor:
+            failed_jobs = report_job_errors(executor.map(job_runner, jobs, chunksize=chunksize))
+    else:
+        failed_jobs = report_job_errors(map(job_runner, jobs))
+        release_documents()
+
+    # Sources with a failed page stay for a retry, their treated pages are simply redone
+    failed_files = {os.path.join(folder, pdf_file) for folder, pdf_file, page_num in failed_jobs}
+    if failed_folders is not None:
+        failed_folders.extend(folder for folder in folders
+                              if folder not in failed_folders and any(job[0] == folder for job in failed_jobs))
+    for file_path in files_to_remove:
+        if file_path not in failed_files:
+            os.remove(file_path)
+    invalidate_folder(*folders)
+
+    if settings['cache']:
+        prune_cache(settings['cache_size'])
+
+    return len(failed_jobs)
+
+def init_worker(report=False, cv2_threads=1, backends=IMAGE_BACKENDS):
+    global worker_records
+    load_backends(*backends)
+    if 'cv2' in backends:
+        # The pool already provides the parallelism, OpenCV only gets this process's share of the cores
+        cv2.setNumThreads(cv2_threads)
+    if report:
+        start_report()
+        worker_records = True
+
+def process_image_job(job, settings=DEFAULT_SETTINGS):
+    folder, pdf_file, page_num = job
+    try:
+        error = process_image(folder, pdf_file, page_num, settings)
+    except Exception as e:
+        error = f"Worker error: {e}"
+    # Workers hand their stage records back with each result
+    return job, error, take_records() if worker_records else []
+
+def worker_cv2_threads(settings, workers):
+    return settings['cv2_threads'] or max(1, DEFAULT_WORKERS // workers)
+
+def report_job_errors(results):
+    failed_jobs = []
+    for (folder, pdf_file, page_num), error, records in results:
+        if records and stage_records is not None:
+            stage_records.extend(records)
+        if error:
+            failed_jobs.append((folder, pdf_file, page_num))
+            print(f"Error in {os.path.join(folder, pdf_file)} page {page_num + 1}: {error}")
+    if failed_jobs:
+        print(f"{len(failed_jobs)} page(s) failed.")
+    return failed_jobs
+
+def process_image(folder, pdf_file, page_num, settings=DEFAULT_SETTINGS):
     pdf_path = os.path.join(folder, pdf_file)
-    doc = fitz.open(pdf_path)
+    set_page_context(pdf_path, page_num)
+    doc = acquire_document(pdf_path)
     page = doc[page_num]
-    pixmap = page.get_pixmap(matrix=fitz.Matrix(200 / 72, 200 / 72))
-    img = Image.frombytes("RGB", [pixmap.width, pixmap.height], pixmap.samples)
     img_path = os.path.join(folder, f"{os.path.splitext(pdf_file)[0]}_page_{page_num + 1}.jpg")
 
     try:
-        Image.MAX_IMAGE_PIXELS = None
-        image = np.array(img)
+        # Page-range chunks get one treated file per page
+        output_name = "treated_" + os.path.splitext(os.path.basename(pdf_file))[0]
+        if doc.page_count > 1:
+            output_name += f"_page_{page_num + 1}"
+        output_path = os.path.join(folder, output_name + ".jpg")
+
+        if settings['passthrough'] and not page_needs_treatment(page):
+            # Kept as a PDF under the treated name so conversion and merge order stay the same
+            passthrough_path = os.path.join(folder, output_name + ".pdf")
+            with fitz.open() as passthrough_doc:
+                passthrough_doc.insert_pdf(page.parent, from_page=page_num, to_page=page_num)
+                passthrough_doc.save(passthrough_path, garbage=3, deflate=True)
+            return None
+
+        # The resolution is stored in the JPEG, so conversion can size the page like its source
+        key = cache_key(page, settings, 'jpeg-dpi') if settings['cache'] else None
+        cached_page = cache_get(key) if key else None
+
+        if cached_page:
+            image_bytes = cached_page[1]
+        else:
+            filtered_image = treat_page(page, settings)
+
+            if filtered_image is None:
+                return f"Error! Skipping file: {img_path}"
 
-        if image is not None:
-            if image.shape[1] > max_width:
-                ratio = max_width / image.shape[1]
-                new_height = int(image.shape[0] * ratio)
+            dpi = filtered_image.shape[1] * 72 / page.rect.width
+            image_bytes = encode_image(filtered_image, settings['quality'], dpi)
+            if key:
+                height, width = filtered_image.shape[:2]
+                cache_put(key, ('jpeg', image_bytes, width, height))
 
-                if new_height > 0:
-                    raw_image = Image.fromarray(image)
-                    new_size = (max_width, new_height)
-                    raw_resampled_image = raw_image.resize(new_size, resample=Image.LANCZOS)
-                    image = np.array(raw_resampled_image)
+        with measure_stage('write', bytes_written=len(image_bytes)):
+            with open(output_path, 'wb') as output_file:
+                output_file.write(image_bytes)
 
-            filtered_image = filter_image(image)
+    except Exception as e:
+        return f"Error processing file {img_path}: {e}"
+
+    return None
+
+def page_needs_treatment(page):
+    page_area = page.rect.get_area()
+    if not page_area:
+        return False
+
+    image_area = 0
+    for image_info in page.get_image_info():
+        image_area += (fitz.Rect(image_info['bbox']) & page.rect).get_area()
+    coverage = min(1, image_area / page_area)
+
+    if coverage >= SCAN_COVERAGE:
+        return True
+    return coverage >= IMAGE_COVERAGE and not page.get_text("text").strip()
+
+def page_hash(page):
+    doc = page.parent
+    digest = hashlib.sha256(f"{tuple(page.rect)}:{page.rotation}".encode())
+    digest.update(page.read_contents())
+
+    # Resource streams are hashed by content so the same page hashes alike in any file
+    xrefs = {image[0] for image in page.get_images(full=True)} | {xobject[0] for xobject in page.get_xobjects()}
+    for stream_digest in sorted(hashlib.sha256(doc.xref_stream_raw(xref) or b'').digest() for xref in xrefs):
+        digest.update(stream_digest)
+
+    # Embedded font programs, two subsets of one font can share a name but not their glyphs
+    for font in page.get_fonts():
+        digest.update(repr(font[1:6]).encode())
+        digest.update(hashlib.sha256(doc.extract_font(font[0])[3] or b'').digest())
+
+    # Annotations and form fields are rendered from their appearance streams, stamps and filled
+    # values change the pixels without touching the page contents
+    for annot in list(page.annots()) + list(page.widgets()):
+        flags, state = doc.xref_get_key(annot.xref, 'F')[1], doc.xref_get_key(annot.xref, 'AS')[1]
+        digest.update(f"{tuple(annot.rect)}:{flags}:{state}".encode())
+        kind, appearance = doc.xref_get_key(annot.xref, 'AP/N')
+        if kind == 'xref':
+            appearance_xrefs = [int(appearance.split()[0])]
+        else:
+            # One stream per state, checkboxes and radio buttons
+            appearance_xrefs = [int(xref) for xref in re.findall(r'(\d+) 0 R', appearance)]
+        for xref in appearance_xrefs:
+            digest.update(hashlib.sha256(doc.xref_stream_raw(xref) or b'').digest())
 
-            output_filename = "treated_" + os.path.splitext(os.path.basename(pdf_file))[0] + ".jpg"
-            output_path = os.path.join(folder, output_filename)
+    return digest.digest()
 
-            img = Image.fromarray(filtered_image)
-            img.save(output_path, 'JPEG', quality=quality)
+def cache_key(page, settings, output):
+    params = json.dumps({key: settings[key] for key in CACHE_KEYS}, sort_keys=True)
+    digest = hashlib.sha256(page_hash(page))
+    digest.update(f"{output}:{params}".encode())
+    return digest.hexdigest()
 
-        else:
-            print(f"Error! Skipping file: {img_path}")
-    except Exception as e:
-        print(f"Error processing file {img_path}: {e}")
+def cache_path(key):
+    return os.path.join(CACHE_FOLDER, key[:2], key)
 
-def filter_image(image):
+def cache_get(key):
+    path = cache_path(key)
     try:
-        gray_image = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
-        denoised_image = cv2.GaussianBlur(gray_image, (5, 5), 0)
-        bilateral_filtered_image = cv2.bilateralFilter(denoised_image, d=5, sigmaColor=10, sigmaSpace=10)
-        sharpened_image = sharpen_image(bilateral_filtered_image)
-        restore_image = cv2.cvtColor(sharpened_image, cv2.COLOR_GRAY2RGB)
+        with open(path, 'rb') as cache_file:
+            data = cache_file.read()
+        # The mtime doubles as the last use for eviction
+        os.utime(path)
+    except OSError:
+        return None
 
-        return restore_image
+    kind, width, height = CACHE_HEADER.unpack_from(data)
+    return kind.rstrip(b'\0').decode(), data[CACHE_HEADER.size:], width, height
+
+def cache_put(key, encoded_page):
+    kind, data, width, height = encoded_page
+    path = cache_path(key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    # Write aside and rename so concurrent workers never read a partial entry
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp_path, 'wb') as cache_file:
+        cache_file.write(CACHE_HEADER.pack(kind.encode(), width, height))
+        cache_file.write(data)
+    os.replace(temp_path, path)
+
+def prune_cache(max_bytes):
+    entries = []
+    for root, _, files in os.walk(CACHE_FOLDER):
+        for file in files:
+            path = os.path.join(root, file)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+    total_size = sum(size for _, size, _ in entries)
+    entries.sort()
+
+    for _, size, path in entries:
+        if total_size <= max_bytes:
+            break
+        try:
+            os.remove(path)
+            total_size -= size
+        except OSError:
+            pass
+
+def page_zoom(page, dpi, max_width):
+    zoom = dpi / 72
+    if max_width and page.rect.width * zoom > max_width:
+        zoom = max_width / page.rect.width
+    return zoom
+
+def render_page(page, dpi=200, max_width=1500, supersample=False, grayscale=False):
+    # Let MuPDF produce the final pixel size directly unless supersampling was asked for
+    zoom = dpi / 72 if supersample else page_zoom(page, dpi, max_width)
+    colorspace = fitz.csGRAY if grayscale else fitz.csRGB
+    with measure_stage('render') as record:
+        pixmap = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), colorspace=colorspace)
+        image = pixmap_to_array(pixmap)
+        record['pixels'] = pixmap.width * pixmap.height
+
+    if supersample:
+        image = resize_image(image, max_width)
+
+    return image
+
+def pixmap_to_array(pixmap):
+    image = np.frombuffer(pixmap.samples, dtype=np.uint8)
+    if pixmap.n == 1:
+        return image.reshape(pixmap.height, pixmap.width)
+    return image.reshape(pixmap.height, pixmap.width, pixmap.n)
+
+def resize_image(image, max_width):
+    if image.shape[1] > max_width:
+        ratio = max_width / image.shape[1]
+        new_height = int(image.shape[0] * ratio)
+
+        if new_height > 0:
+            with measure_stage('resize', pixels=image.shape[0] * image.shape[1]):
+                raw_image = Image.fromarray(image)
+                new_size = (max_width, new_height)
+                raw_resampled_image = raw_image.resize(new_size, resample=Image.LANCZOS)
+                image = np.array(raw_resampled_image)
+
+    return image
+
+def treat_page(page, settings=DEFAULT_SETTINGS):
+    if settings['tile_height']:
+        return treat_page_tiled(page, settings)
+
+    return filter_image(render_page_image(page, settings), settings['color_mode'], settings['filters'])
+
+def render_page_image(page, settings=DEFAULT_SETTINGS):
+    grayscale = settings['color_mode'] != 'rgb'
+    return render_page(page, settings['dpi'], settings['max_width'], settings['supersample'], grayscale)
+
+def treat_page_tiled(page, settings=DEFAULT_SETTINGS):
+    color_mode = settings['color_mode']
+    grayscale = color_mode != 'rgb'
+    colorspace = fitz.csGRAY if grayscale else fitz.csRGB
+    rect = page.rect
+
+    zoom = page_zoom(page, settings['dpi'], settings['max_width'])
+    if settings['max_pixels'] and rect.width * rect.height * zoom * zoom > settings['max_pixels']:
+        zoom = (settings['max_pixels'] / (rect.width * rect.height)) ** 0.5
+    matrix = fitz.Matrix(zoom, zoom)
+
+    page_irect = (rect * matrix).irect
+    width, height = page_irect.width, page_irect.height
+    tile_height = settings['tile_height']
+    # One extra row covers rounding of the clip to whole pixels
+    halo = sum(filter_radius(step, params) for step, params in filter_chain(settings['filters'])) + 1
+
+    output_image = np.full((height, width) if grayscale else (height, width, 3), 255, dtype=np.uint8)
+
+    for top in range(0, height, tile_height):
+        bottom = min(height, top + tile_height)
+        clip_top = max(0, top - halo)
+        clip_bottom = min(height, bottom + halo)
+        clip = fitz.Rect(rect.x0, rect.y0 + (page_irect.y0 + clip_top) / zoom,
+                         rect.x1, rect.y0 + (page_irect.y0 + clip_bottom) / zoom)
+
+        with measure_stage('render') as record:
+            pixmap = page.get_pixmap(matrix=matrix, colorspace=colorspace, clip=clip)
+            strip = pixmap_to_array(pixmap)
+            record['pixels'] = pixmap.width * pixmap.height
+
+        # Bilevel thresholds the whole page below, a per-strip Otsu level would band
+        filtered_strip = filter_image(strip, 'gray' if color_mode == 'bilevel' else color_mode, settings['filters'])
+        if filtered_strip is None:
+            return None
+
+        offset = pixmap.y - page_irect.y0
+        columns = min(width, filtered_strip.shape[1])
+        output_image[top:bottom, :columns] = filtered_strip[top - offset:bottom - offset, :columns]
+
+    if color_mode == 'bilevel':
+        with measure_stage('threshold', pixels=output_image.size):
+            cv2.threshold(output_image, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU, dst=output_image)
+
+    return output_image
+
+def encode_image(image, quality=35, dpi=None):
+    with measure_stage('encode', pixels=image.shape[0] * image.shape[1]) as record:
+        buffer = io.BytesIO()
+        if dpi:
+            Image.fromarray(image).save(buffer, 'JPEG', quality=quality, dpi=(dpi, dpi))
+        else:
+            Image.fromarray(image).save(buffer, 'JPEG', quality=quality)
+        record['bytes_written'] = buffer.tell()
+    return buffer.getvalue()
+
+def encode_page(image, settings=DEFAULT_SETTINGS):
+    height, width = image.shape[:2]
+    if settings['color_mode'] == 'bilevel':
+        with measure_stage('encode', pixels=width * height) as record:
+            # DeviceGray at 1 bit per pixel, rows padded to whole bytes, 1 is white
+            packed = np.packbits(image > 127, axis=1)
+            data = zlib.compress(packed.tobytes())
+            record['bytes_written'] = len(data)
+        return 'bilevel', data, width, height
+    return 'jpeg', encode_image(image, settings['quality']), width, height
+
+def decode_bilevel(encoded_page):
+    _, data, width, height = encoded_page
+    packed = np.frombuffer(zlib.decompress(data), dtype=np.uint8).reshape(height, -1)
+    return np.unpackbits(packed, axis=1)[:, :width] * 255
+
+def add_image_page(output_doc, rect, encoded_page):
+    kind, data, width, height = encoded_page
+    output_page = output_doc.new_page(width=rect.width, height=rect.height)
+
+    if kind == 'bilevel':
+        xref = output_doc.get_new_xref()
+        output_doc.update_object(xref, f"<</Type/XObject/Subtype/Image/Width {width}/Height {height}/ColorSpace/DeviceGray/BitsPerComponent 1>>")
+        output_doc.update_stream(xref, data, new=True, compress=False)
+        output_doc.xref_set_key(xref, "Filter", "/FlateDecode")
+        output_page.insert_image(output_page.rect, xref=xref)
+    else:
+        output_page.insert_image(output_page.rect, stream=data)
+
+    return output_page
+
+def filter_chain(filters):
+    chain = []
+    for step in filters:
+        step, params = (step, {}) if isinstance(step, str) else step
+        if step not in FILTER_STEPS:
+            raise ValueError(f"unknown filter step '{step}'")
+        unknown_params = set(params) - set(FILTER_STEPS[step])
+        if unknown_params:
+            raise ValueError(f"unknown parameters for '{step}': {', '.join(sorted(unknown_params))}")
+        params = {**FILTER_STEPS[step], **params}
+        # OpenCV only takes positive odd kernel sizes and a positive bilateral diameter
+        if step == 'gaussian' and not (isinstance(params['ksize'], int) and params['ksize'] > 0 and params['ksize'] % 2):
+            raise ValueError(f"gaussian ksize must be a positive odd integer, not {params['ksize']}")
+        if step == 'bilateral' and not (isinstance(params['d'], int) and params['d'] > 0):
+            raise ValueError(f"bilateral d must be a positive integer, not {params['d']}")
+        chain.append((step, params))
+    return chain
+
+def parse_filters(text):
+    if text in FILTER_PRESETS:
+        return FILTER_PRESETS[text]
+
+    # Steps are comma separated, parameters follow the name: gaussian:ksize=3,sharpen
+    filters = []
+    for step in filter(None, text.split(',')):
+        name, *assignments = step.split(':')
+        params = {}
+        for assignment in assignments:
+            key, _, value = assignment.partition('=')
+            params[key] = float(value) if '.' in value else int(value)
+        filters.append((name, params) if params else name)
+    filter_chain(filters)
+    return tuple(filters)
+
+def filter_radius(step, params):
+    # Rows of context a step needs in tiled mode
+    if step == 'gaussian':
+        return params['ksize'] // 2
+    if step == 'bilateral':
+        return params['d'] // 2
+    return 1
+
+@lru_cache(maxsize=None)
+def sharpen_kernel(strength=1):
+    kernel = np.full((3, 3), -strength, dtype=np.float32)
+    kernel[1, 1] = 8 * strength + 1
+    return kernel
+
+def apply_filter(step, params, src, dst):
+    if step == 'gaussian':
+        return cv2.GaussianBlur(src, (params['ksize'], params['ksize']), params['sigma'], dst=dst)
+    if step == 'bilateral':
+        return cv2.bilateralFilter(src, params['d'], params['sigma_color'], params['sigma_space'], dst=dst)
+    return cv2.filter2D(src, -1, sharpen_kernel(params['strength']), dst=dst)
+
+def filter_buffer(slot, shape):
+    buffers = getattr(filter_buffers, 'frames', None)
+    if buffers is None:
+        buffers = filter_buffers.frames = {}
+    buffer = buffers.get(slot)
+    if buffer is None or buffer.shape != shape:
+        buffer = buffers[slot] = np.empty(shape, dtype=np.uint8)
+    return buffer
+
+def filter_image(image, color_mode='rgb', filters=DEFAULT_SETTINGS['filters']):
+    try:
+        pixels = image.shape[0] * image.shape[1]
+        shape = image.shape[:2]
+
+        steps = []
+        if image.ndim == 3:
+            steps.append(('gray', lambda src, dst: cv2.cvtColor(src, cv2.COLOR_RGB2GRAY, dst=dst), shape))
+        for step, params in filter_chain(filters):
+            steps.append((step, partial(apply_filter, step, params), shape))
+        if color_mode == 'bilevel':
+            steps.append(('threshold', lambda src, dst: cv2.threshold(src, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU, dst=dst)[1], shape))
+        elif color_mode == 'rgb':
+            steps.append(('restore', lambda src, dst: cv2.cvtColor(src, cv2.COLOR_GRAY2RGB, dst=dst), shape + (3,)))
+
+        # Steps alternate between two per-thread buffers, only the result is a new array
+        # since it is handed on to the next pipeline stage
+        filtered_image = image
+        for index, (step, run, step_shape) in enumerate(steps):
+            if index == len(steps) - 1:
+                dst = np.empty(step_shape, dtype=np.uint8)
+            else:
+                dst = filter_buffer(index % 2, step_shape)
+            with measure_stage(step, pixels=pixels):
+                filtered_image = run(filtered_image, dst)
+
+        return filtered_image
     except Exception as e:
         print(f"Error filtering image: {e}")
         return None
 
 def sharpen_image(image):
-    kernel = np.array([[-1, -1, -1],
-                       [-1,  9, -1],
-                       [-1, -1, -1]])
-    sharpened_image = cv2.filter2D(image, -1, kernel)
-    return sharpened_image
-
-def convert_image_to_pdf(processed_folders):
-    try:
-        for folder_path in processed_folders:
-            jpg_files = get_files_with_extension(folder_path, '.jpg')
-
-            if not jpg_files:
-                print(f"No JPG files found in the folder: {folder_path}")
-                continue
+    return cv2.filter2D(image, -1, sharpen_kernel())
+
+@stage('convert', 'Image', 'fitz')
+def convert_image_to_pdf(processed_folders, pages_per_save=MERGE_PAGES_PER_SAVE, garbage=3):
+    failed = 0
+    for folder_path in processed_folders:
+        folder_name = os.path.basename(folder_path)
+        output_pdf_file = os.path.join(folder_path, f"{folder_name}_merged.pdf")
+        jpg_files = get_files_with_extension(folder_path, '.jpg')
+
+        if not jpg_files:
+            print(f"No JPG files found in the folder: {folder_path}")
+            continue
+
+        # Passthrough pages were kept as treated PDFs, they are interleaved with the images in page order
+        all_pdf_files = get_files_with_extension(folder_path, '.pdf')
+        pdf_files = [f for f in all_pdf_files if f.startswith('treated_')]
+        input_files = sorted(jpg_files + pdf_files, key=natural_sort_key)
+        input_paths = [os.path.join(folder_path, input_file) for input_file in input_files]
+
+        # An image rendered from a split page replaces that page, as the per-image PDF once overwrote it
+        replaced_files = {os.path.splitext(f)[0] + '.pdf' for f in jpg_files} & set(all_pdf_files)
+        replaced_paths = [os.path.join(folder_path, f) for f in sorted(replaced_files - set(pdf_files))]
+
+        try:
+            set_page_context(output_pdf_file)
+            merge_files(input_paths, output_pdf_file, pages_per_save, garbage)
+        except Exception as e:
+            print(f"Error converting images to PDF in folder {folder_path}: {e}")
+            if os.path.exists(output_pdf_file):
+                os.remove(output_pdf_file)
+                print(f"Removed incomplete merged file: '{output_pdf_file}'")
+            failed += 1
+            continue
+
+        # Inputs go only once the merged file is on disk
+        for input_path in input_paths + replaced_paths:
+            os.remove(input_path)
+
+    invalidate_folder(*processed_folders)
+    return failed
+
+def add_jpeg_page(output_doc, jpg_path):
+    # Only the header is read for the size, the JPEG stream is embedded as is (DCTDecode)
+    with Image.open(jpg_path) as image:
+        width, height = image.size
+        dpi = image.info.get('dpi', (72, 72))
+    with open(jpg_path, 'rb') as jpg_file:
+        data = jpg_file.read()
+
+    # Treated and rendered pages carry the resolution they were rendered at, so they come back at the
+    # size of their source page next to passthrough pages. Without one, one pixel per point as PIL did
+    x_dpi, y_dpi = (float(dpi[0]) or 72, float(dpi[1]) or 72)
+    output_page = output_doc.new_page(width=width * 72 / x_dpi, height=height * 72 / y_dpi)
+    output_page.insert_image(output_page.rect, stream=data)
+    return output_page
+
+@stage('merge', 'fitz')
+def merge_pdfs(processed_folders, pages_per_save=MERGE_PAGES_PER_SAVE, garbage=3, deflate=True):
+    failed = 0
+    for folder_path in processed_folders:
+        folder_name = os.path.basename(folder_path)
+        output_pdf_file = os.path.join(folder_path, f"{folder_name}_merged.pdf")
+        pdf_files = [f for f in get_files_with_extension(folder_path, '.pdf') if f != os.path.basename(output_pdf_file)]
 
-            jpg_files.sort(key=natural_sort_key)
-
-            for jpg_file in jpg_files:
-                jpg_file_path = os.path.join(folder_path, jpg_file)
-                image = Image.open(jpg_file_path)
-
-                pdf_file_path = jpg_file_path.replace(".jpg", ".pdf")
-                image.save(pdf_file_path, "PDF")
+        if os.path.exists(output_pdf_file):
+            # Finished output is never replaced, leftover PDFs next to it are for the user to look at
+            if pdf_files:
+                print(f"Folder already merged, skipping {len(pdf_files)} other PDF file(s): {folder_path}")
+            else:
+                print(f"Folder already merged: {folder_path}")
+            continue
+
+        if not pdf_files:
+            print(f"No PDF files found in the folder: {folder_path}")
+            continue
+
+        if len(pdf_files) == 1:
+            print(f"Only one PDF file found in the folder: {folder_path}. Renaming the file.")
+            pdf_file = pdf_files[0]
+            old_path = os.path.join(folder_path, pdf_file)
+            new_path = os.path.join(folder_path, f"{os.path.basename(folder_path)}.pdf")
+            os.rename(old_path, new_path)
+            continue
+
+        pdf_files.sort(key=natural_sort_key)
+        pdf_paths = [os.path.join(folder_path, pdf_file) for pdf_file in pdf_files]
+
+        try:
+            set_page_context(output_pdf_file)
+            merge_files(pdf_paths, output_pdf_file, pages_per_save, garbage, deflate)
+        except Exception as e:
+            print(f"Error merging PDFs in folder {folder_path}: {e}")
+            if os.path.exists(output_pdf_file):
+                os.remove(output_pdf_file)
+                print(f"Removed incomplete merged file: '{output_pdf_file}'")
+            failed += 1
+            continue
+
+        # Inputs go only once the merged file is on disk
+        for pdf_path in pdf_paths:
+            os.remove(pdf_path)
+
+    invalidate_folder(*processed_folders)
+    return failed
+
+def merge_files(input_paths, output_pdf_file, pages_per_save=MERGE_PAGES_PER_SAVE, garbage=3, deflate=True):
+    # Inputs are PDFs, whose pages are copied, or JPEGs, which become one page each
+    partial_file = output_pdf_file + '.part'
+    merged_doc = fitz.open()
+    pages_since_save = 0
 
-            for jpg_file in jpg_files:
-                jpg_file_path = os.path.join(folder_path, jpg_file)
-                os.remove(jpg_file_path)
+    try:
+        for input_path in input_paths:
+            if input_path.lower().endswith('.jpg'):
+                with measure_stage('convert', bytes_read=os.path.getsize(input_path)):
+                    add_jpeg_page(merged_doc, input_path)
+                    pages_since_save += 1
+            else:
+                with measure_stage('merge', bytes_read=os.path.getsize(input_path)):
+                    with fitz.open(input_path) as pdf_doc:
+                        merged_doc.insert_pdf(pdf_doc)
+                        pages_since_save += pdf_doc.page_count
+
+            if pages_since_save >= pages_per_save:
+                # Flush to the partial file and reopen it, so only the latest chunk stays in memory
+                with measure_stage('flush'):
+                    if merged_doc.name:
+                        merged_doc.saveIncr()
+                    else:
+                        merged_doc.save(partial_file)
+                    merged_doc.close()
+                    merged_doc = fitz.open(partial_file)
+                pages_since_save = 0
+
+        with measure_stage('save') as record:
+            merged_doc.save(output_pdf_file, garbage=garbage, deflate=deflate)
+            merged_doc.close()
+            with open(output_pdf_file, 'r+b') as output_file:
+                os.fsync(output_file.fileno())
+            record['bytes_written'] = os.path.getsize(output_pdf_file)
+
+    finally:
+        if not merged_doc.is_closed:
+            merged_doc.close()
+        if os.path.exists(partial_file):
+            os.remove(partial_file)
+
+def run_stage(stage, input_queue, output_queue):
+    while True:
+        item = input_queue.get()
+        if item is None:
+            output_queue.put(None)
+            return
+
+        key, payload, error = item
+        if error is None:
+            try:
+                payload = stage(key, payload)
+            except Exception as e:
+                payload, error = None, str(e)
+        output_queue.put((key, payload, error))
+
+def run_pipeline(source, stages, consume, depth=4):
+    # source yields (key, payload, error) and consume runs on the calling thread, in source order
+    if depth <= 0:
+        for key, payload, error in source:
+            for stage in stages:
+                if error is None:
+                    try:
+                        payload = stage(key, payload)
+                    except Exception as e:
+                        payload, error = None, str(e)
+            consume(key, payload, error)
+        return
+
+    # Bounded queues give backpressure, only the finished queue is unbounded so no stage can deadlock
+    queues = [queue.Queue(maxsize=depth) for _ in stages] + [queue.Queue()]
+    threads = [threading.Thread(target=run_stage, args=(stage, queues[i], queues[i + 1]), daemon=True)
+               for i, stage in enumerate(stages)]
+    for thread in threads:
+        thread.start()
+
+    finished = queues[-1]
+    completed = False
+    try:
+        for item in source:
+            queues[0].put(item)
+            while not finished.empty():
+                consume(*finished.get())
+        completed = True
+    finally:
+        queues[0].put(None)
+        for result in iter(finished.get, None):
+            if completed:
+                consume(*result)
+        for thread in threads:
+            thread.join()
+
+@stage('process_pdf', *IMAGE_BACKENDS)
+def process_pdf(input_pdf, output_folder, settings=DEFAULT_SETTINGS, keep_images=False):
+    input_filename = os.path.splitext(os.path.basename(input_pdf))[0]
+    input_filename = transform_filename(input_filename)
+    os.makedirs(output_folder, exist_ok=True)
 
-    except Exception as e:
-        print(f"Error converting images to PDF in folder {folder_path}: {e}")
+    folder_name = os.path.basename(output_folder)
+    output_pdf_file = os.path.join(output_folder, f"{folder_name}_merged.pdf")
 
-def merge_pdfs(processed_folders):
-    try:
-        for folder_path in processed_folders:
-            pdf_files = get_files_with_extension(folder_path, '.pdf')
+    page_rects = {}
+    failed_pages = []
 
-            if not pdf_files:
-                print(f"No PDF files found in the folder: {folder_path}")
+    # MuPDF is only used from this thread: rendering here, inserting in consume
+    def render_stage():
+        for page_num in range(source_doc.page_count):
+            set_page_context(input_pdf, page_num)
+            page = source_doc[page_num]
+            page_rects[page_num] = page.rect
+            try:
+                # Payload is (image, filtered, encoded_page, cache key)
+                if settings['passthrough'] and not page_needs_treatment(page):
+                    yield page_num, (None, True, ('passthrough', None, 0, 0), None), None
+                    continue
+
+                key = cache_key(page, settings, 'page') if settings['cache'] else None
+                cached_page = cache_get(key) if key else None
+                if cached_page:
+                    payload = (None, True, cached_page, None)
+                elif settings['tile_height']:
+                    payload = (treat_page_tiled(page, settings), True, None, key)
+                else:
+                    payload = (render_page_image(page, settings), False, None, key)
+            except Exception as e:
+                yield page_num, None, str(e)
                 continue
+            yield page_num, payload, None
+
+    def filter_stage(page_num, payload):
+        set_page_context(input_pdf, page_num)
+        image, filtered, encoded_page, key = payload
+        if not filtered:
+            image = filter_image(image, settings['color_mode'], settings['filters'])
+            if image is None:
+                raise ValueError("filtering failed")
+        return image, encoded_page, key
+
+    def encode_stage(page_num, payload):
+        set_page_context(input_pdf, page_num)
+        image, encoded_page, key = payload
+        if encoded_page is None:
+            encoded_page = encode_page(image, settings)
+            if key:
+                cache_put(key, encoded_page)
+        return image, encoded_page
+
+    def write_stage(page_num, payload):
+        set_page_context(input_pdf, page_num)
+        image, encoded_page = payload
+        if keep_images and encoded_page[0] != 'passthrough':
+            image_path = os.path.join(output_folder, f"treated_{input_filename}_page_{page_num + 1}.jpg")
+            if encoded_page[0] == 'jpeg':
+                image_bytes = encoded_page[1]
+            else:
+                image_bytes = encode_image(image if image is not None else decode_bilevel(encoded_page), settings['quality'])
+            with measure_stage('write', bytes_written=len(image_bytes)):
+                with open(image_path, 'wb') as image_file:
+                    image_file.write(image_bytes)
+        return encoded_page
 
-            if len(pdf_files) == 1:
-                print(f"Only one PDF file found in the folder: {folder_path}. Renaming the file.")
-                pdf_file = pdf_files[0]
-                old_path = os.path.join(folder_path, pdf_file)
-                new_path = os.path.join(folder_path, f"{os.path.basename(folder_path)}.pdf")
-                os.rename(old_path, new_path)
-                continue
+    try:
+        source_doc = acquire_document(input_pdf)
+
+        # Each page goes render -> filter -> encode in memory and straight into the output document
+        with fitz.open() as output_doc:
+            print(f"Processing '{input_filename}' with {source_doc.page_count} pages.")
+
+            def consume(page_num, encoded_page, error):
+                rect = page_rects.pop(page_num)
+                if error:
+                    print(f"Error! Skipping page {page_num + 1} of '{input_filename}': {error}")
+                    failed_pages.append(page_num)
+                    return
+
+                set_page_context(input_pdf, page_num)
+                with measure_stage('insert'):
+                    if encoded_page[0] == 'passthrough':
+                        output_doc.insert_pdf(source_doc, from_page=page_num, to_page=page_num)
+                    else:
+                        add_image_page(output_doc, rect, encoded_page)
 
-            pdf_files.sort(key=natural_sort_key)
+            run_pipeline(render_stage(), [filter_stage, encode_stage, write_stage], consume,
+                         settings['pipeline_depth'])
 
-            pdf_document = fitz.open()
-            folder_name = os.path.basename(folder_path)
-            output_pdf_file = os.path.join(folder_path, f"{folder_name}_merged.pdf")
+            if output_doc.page_count == 0:
+                print(f"No pages could be processed in '{input_filename}'.")
+                release_document(input_pdf)
+                return None, len(failed_pages)
 
-            for pdf_file in pdf_files:
-                pdf_file_path = os.path.join(folder_path, pdf_file)
-                pdf_document.insert_pdf(fitz.open(pdf_file_path), from_page=0)
-                os.remove(pdf_file_path)
+            set_page_context(input_pdf)
+            with measure_stage('save', bytes_read=os.path.getsize(input_pdf)) as record:
+                output_doc.save(output_pdf_file, garbage=3, deflate=True)
+                record['bytes_written'] = os.path.getsize(output_pdf_file)
 
-            pdf_document.save(output_pdf_file)
-            pdf_document.close()
+        # The output is kept, but pages missing from it still make the document a failure
+        if failed_pages:
+            print(f"{len(failed_pages)} page(s) missing from '{output_pdf_file}'.")
+        release_document(input_pdf)
+        return output_folder, len(failed_pages)
 
     except Exception as e:
-        print(f"Error merging PDFs in folder {folder_path}: {e}")
+        print(f"Error processing PDF '{input_pdf}': {e}")
+        release_document(input_pdf)
         if os.path.exists(output_pdf_file):
             os.remove(output_pdf_file)
-            print(f"Removed incomplete merged file: '{output_pdf_file}'")
+            print(f"Removed incomplete output file: '{output_pdf_file}'")
+        return None, len(failed_pages)
+
+    finally:
+        invalidate_folder(output_folder, os.path.dirname(os.path.abspath(output_folder)))
+
+def process_pdf_job(job, settings=DEFAULT_SETTINGS, keep_images=False):
+    pdf_file, output_folder = job
+    output_folder, failed_pages = process_pdf(pdf_file, output_folder, settings, keep_images)
+    return output_folder, failed_pages, take_records() if worker_records else []
+
+@stage('process', *IMAGE_BACKENDS)
+def process_pdfs(pdf_files, settings=DEFAULT_SETTINGS, keep_images=False, workers=1):
+    jobs = [(pdf_file, generate_default_output_folder(pdf_file)) for pdf_file in pdf_files]
+    job_runner = partial(process_pdf_job, settings=settings, keep_images=keep_images)
+
+    # Whole documents per worker, each one still runs its own staged pipeline
+    if workers > 1 and len(jobs) > 1:
+        release_documents()
+        workers = min(workers, len(jobs))
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                 initargs=(stage_records is not None, worker_cv2_threads(settings, workers))) as executor:
+            results = list(executor.map(job_runner, jobs))
+    else:
+        results = [job_runner(job) for job in jobs]
+
+    # Documents without output and pages missing from an output both count as failures
+    processed_folders = []
+    failed = 0
+    for output_folder, failed_pages, records in results:
+        if records and stage_records is not None:
+            stage_records.extend(records)
+        if output_folder:
+            processed_folders.append(output_folder)
+        else:
+            failed += 1
+        failed += failed_pages
+    if settings['cache']:
+        prune_cache(settings['cache_size'])
+    print("Processing complete.")
+    return processed_folders, failed
+
+def queue_folders(intake):
+    root = os.path.join(intake, QUEUE_FOLDER)
+    return {name: os.path.join(root, name) for name in QUEUE_FOLDERS}
+
+def queue_worker_id():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+def requeue_stale_claims(intake, folders, worker_id, lease_seconds=LEASE_SECONDS, max_attempts=MAX_ATTEMPTS):
+    now = time.time()
+    for pdf_file in get_files_with_extension(folders['claimed'], '.pdf'):
+        claimed_path = os.path.join(folders['claimed'], pdf_file)
+        lease_path = claimed_path + '.lease'
+        try:
+            # Until its lease is written, a fresh claim is aged by the rename that made it
+            if os.path.exists(lease_path):
+                heartbeat = os.stat(lease_path).st_mtime
+            else:
+                heartbeat = os.stat(claimed_path).st_ctime
+            if now - heartbeat < lease_seconds:
+                continue
+            # A dead worker counts as a failed attempt, documents that keep killing workers end in failed
+            give_up = len(read_attempts(folders, pdf_file)) + 1 >= max_attempts
+            # The stale lease goes first, once the document is back in the intake the same path
+            # may already hold the lease of its next owner
+            if os.path.exists(lease_path):
+                os.remove(lease_path)
+            os.rename(claimed_path, os.path.join(folders['failed'] if give_up else intake, pdf_file))
+        except OSError:
+            # Finished, or requeued by another worker in the meantime
+            continue
+        attempts = record_attempt(folders, pdf_file, worker_id, "lease expired")
+        if give_up:
+            print(f"Giving up on '{pdf_file}' after {attempts} attempt(s), the last lease expired.")
+        else:
+            print(f"Requeued stale claim: {pdf_file}")
+
+def claim_document(intake, folders, worker_id):
+    pdf_files = get_files_with_extension(intake, '.pdf')
+    pdf_files.sort(key=natural_sort_key)
 
-def scan_folders(processed_folders):
+    for pdf_file in pdf_files:
+        claimed_path = os.path.join(folders['claimed'], pdf_file)
+        # The rename is the claim, only one worker can move the file out of the intake
+        try:
+            os.rename(os.path.join(intake, pdf_file), claimed_path)
+        except OSError:
+            continue
+        with open(claimed_path + '.lease', 'w') as lease_file:
+            json.dump({'worker': worker_id, 'claimed': time.time()}, lease_file)
+        return pdf_file
+    return None
+
+def keep_lease(lease_path, stop, interval):
+    while not stop.wait(interval):
+        try:
+            os.utime(lease_path)
+        except OSError:
+            return
+
+def read_attempts(folders, pdf_file):
     try:
-        root_folder = os.getcwd()
-        subfolders = [f.path for f in os.scandir(root_folder) if f.is_dir()]
+        with open(os.path.join(folders['attempts'], pdf_file + '.json')) as attempts_file:
+            return json.load(attempts_file)
+    except (OSError, ValueError):
+        return []
+
+def record_attempt(folders, pdf_file, worker_id, error=None):
+    attempts_path = os.path.join(folders['attempts'], pdf_file + '.json')
+    attempts = read_attempts(folders, pdf_file)
+
+    if error:
+        attempts.append({'worker': worker_id, 'time': datetime.now().isoformat(), 'error': error})
+        with open(attempts_path, 'w') as attempts_file:
+            json.dump(attempts, attempts_file, indent=2)
+    elif os.path.exists(attempts_path):
+        os.remove(attempts_path)
+    return len(attempts)
+
+def run_queue_worker(intake, settings=DEFAULT_SETTINGS, keep_images=False,
+                     lease_seconds=LEASE_SECONDS, max_attempts=MAX_ATTEMPTS):
+    folders = queue_folders(intake)
+    worker_id = queue_worker_id()
+    processed = failed = 0
+
+    while True:
+        requeue_stale_claims(intake, folders, worker_id, lease_seconds, max_attempts)
+        pdf_file = claim_document(intake, folders, worker_id)
+        if pdf_file is None:
+            break
+
+        claimed_path = os.path.join(folders['claimed'], pdf_file)
+        lease_path = claimed_path + '.lease'
+        stop = threading.Event()
+        heartbeat = threading.Thread(target=keep_lease, args=(lease_path, stop, lease_seconds / 4), daemon=True)
+        heartbeat.start()
+
+        # Outputs land next to the intake, as if the document had been processed in place
+        output_folder = generate_default_output_folder(os.path.join(intake, pdf_file))
+        try:
+            processed_folder, failed_pages = process_pdf(claimed_path, output_folder, settings, keep_images)
+            if processed_folder is None:
+                error = "processing failed"
+            elif failed_pages:
+                error = f"{failed_pages} page(s) failed"
+            else:
+                error = None
+        except Exception as e:
+            error = str(e)
+        finally:
+            stop.set()
+            heartbeat.join()
+
+        attempts = record_attempt(folders, pdf_file, worker_id, error)
+        if error is None:
+            target_folder = folders['done']
+            processed += 1
+        elif attempts >= max_attempts:
+            print(f"Giving up on '{pdf_file}' after {attempts} attempt(s).")
+            target_folder = folders['failed']
+            failed += 1
+        else:
+            print(f"Releasing '{pdf_file}' for retry, attempt {attempts} of {max_attempts} failed.")
+            target_folder = intake
+
+        # Lease first for the same reason as in requeue_stale_claims
+        if os.path.exists(lease_path):
+            os.remove(lease_path)
+        try:
+            os.rename(claimed_path, os.path.join(target_folder, pdf_file))
+        except OSError as e:
+            print(f"Lost the claim on '{pdf_file}': {e}")
+
+    return processed, failed, take_records() if worker_records else []
+
+@stage('queue', *IMAGE_BACKENDS)
+def run_queue(intake, settings=DEFAULT_SETTINGS, keep_images=False, workers=1,
+              lease_seconds=LEASE_SECONDS, max_attempts=MAX_ATTEMPTS):
+    for folder in queue_folders(intake).values():
+        os.makedirs(folder, exist_ok=True)
+    worker_runner = partial(run_queue_worker, intake, settings, keep_images, lease_seconds, max_attempts)
+
+    # Every worker, on this node or another, drains the same intake until nothing is left to claim
+    if workers > 1:
+        release_documents()
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                 initargs=(stage_records is not None, worker_cv2_threads(settings, workers))) as executor:
+            futures = [executor.submit(worker_runner) for _ in range(workers)]
+            results = [future.result() for future in futures]
+    else:
+        results = [worker_runner()]
+
+    processed = failed = 0
+    for worker_processed, worker_failed, records in results:
+        if records and stage_records is not None:
+            stage_records.extend(records)
+        processed += worker_processed
+        failed += worker_failed
+    if settings['cache']:
+        prune_cache(settings['cache_size'])
+    print(f"Queue drained: {processed} document(s) processed, {failed} moved to failed.")
+    return processed, failed
+
+@stage('scan')
+def scan_folders(processed_folders, root_folder=None, skip_merged=False):
+    try:
+        root_folder = root_folder or os.getcwd()
+        subfolders = [f for f in index_folder(root_folder)['folders'] if os.path.basename(f) != QUEUE_FOLDER]
+        subfolders.sort(key=natural_sort_key)
 
         valid_folders_found = False
 
         for folder_path in subfolders:
-            pdf_files = get_files_with_extension(folder_path, '.pdf')
-            jpg_files = get_files_with_extension(folder_path, '.jpg')
+            entry = index_folder(folder_path)
+            if skip_merged and entry['state'] == 'merged':
+                continue
 
-            if pdf_files or jpg_files:
+            if entry['pdf_count'] or entry['jpg_count']:
                 processed_folders.append(folder_path)
                 valid_folders_found = True
 
@@ -263,6 +1482,27 @@ def scan_folders(processed_folders):
     except Exception as e:
         print(f"Error scanning folders: {e}")
 
+def ask_workers():
+    value = input(f"Number of workers (Enter for {DEFAULT_WORKERS}): ").strip()
+    if not value:
+        return DEFAULT_WORKERS
+    try:
+        return max(1, int(value))
+    except ValueError:
+        print(f"Invalid number of workers, using {DEFAULT_WORKERS}.")
+        return DEFAULT_WORKERS
+
+def ask_settings():
+    color_mode = input("Color mode (rgb/gray/bilevel, Enter for rgb): ").strip().lower() or 'rgb'
+    if color_mode not in ('rgb', 'gray', 'bilevel'):
+        print("Invalid color mode, using rgb.")
+        color_mode = 'rgb'
+    preset = input(f"Filter preset ({'/'.join(FILTER_PRESETS)}, Enter for default): ").strip().lower() or 'default'
+    if preset not in FILTER_PRESETS:
+        print("Invalid filter preset, using default.")
+        preset = 'default'
+    return {**DEFAULT_SETTINGS, 'color_mode': color_mode, 'filters': FILTER_PRESETS[preset]}
+
 def list_files(folder_path):
     files = os.listdir(folder_path)
     files.sort(key=natural_sort_key)
@@ -276,10 +1516,10 @@ def main():
 
         while True:
             try:
-                user_choice = int(input("Choose an option:\n1. Extract Pages\n2. Convert to Image\n3. Convert and Treat Image\n4. Convert Images to PDF\n5. Merge PDFs\n8. Scan Folders\n9. List Folder Info\n0. Exit\n"))
+                user_choice = int(input("Choose an option:\n1. Extract Pages\n2. Convert to Image\n3. Convert and Treat Image\n4. Convert Images to PDF\n5. Merge PDFs\n6. Process PDFs (in memory)\n7. Start/Stop Run Report\n8. Scan Folders\n9. List Folder Info\n0. Exit\n"))
 
                 if user_choice == 1:
-                    processed_folders = extract_pages(pdf_files)
+                    processed_folders, _ = extract_pages(pdf_files)
                 elif user_choice == 2:
                     if not processed_folders:
                         print("No folders processed yet.")
@@ -290,7 +1530,7 @@ def main():
                     if not processed_folders:
                         print("No folders processed yet.")
                     else:
-                        treat_images(processed_folders)
+                        treat_images(processed_folders, workers=ask_workers(), settings=ask_settings())
                         print("Image treatment complete.")
                 elif user_choice == 4:
                     if not processed_folders:
@@ -304,6 +1544,16 @@ def main():
                     else:
                         merge_pdfs(processed_folders)
                         print("Merging PDFs complete.")
+                elif user_choice == 6:
+                    keep_images = input("Keep treated images? (y/N): ").strip().lower() == 'y'
+                    processed_folders, _ = process_pdfs(pdf_files, ask_settings(), keep_images, ask_workers())
+                elif user_choice == 7:
+                    if stage_records is None:
+                        profile = input("Also profile with cProfile? (y/N): ").strip().lower() == 'y'
+                        start_report(profile)
+                        print("Run report started.")
+                    else:
+                        stop_report(f"report_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
                 elif user_choice == 8:
                     if not processed_folders:
                         scan_folders(processed_folders)
@@ -328,6 +1578,158 @@ def main():
 
     input("Press any key to quit...")
 
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Treat scanned PDFs without the menu. Runs the menu when called without arguments.")
+    parser.add_argument('source', help="Folder of PDFs, or a manifest: a JSON list of paths or one path per line")
+    parser.add_argument('--stages', nargs='+', choices=('process', 'extract', 'treat', 'convert', 'merge'),
+                        default=['process'], help="Stages to run in order (default: process)")
+    parser.add_argument('--dpi', type=int, default=DEFAULT_SETTINGS['dpi'])
+    parser.add_argument('--max-width', type=int, default=DEFAULT_SETTINGS['max_width'])
+    parser.add_argument('--quality', type=int, default=DEFAULT_SETTINGS['quality'])
+    parser.add_argument('--color-mode', choices=('rgb', 'gray', 'bilevel'), default=DEFAULT_SETTINGS['color_mode'])
+    parser.add_argument('--filters', default='default',
+                        help=f"A preset ({', '.join(FILTER_PRESETS)}) or comma separated steps in order, "
+                             "with optional parameters: gaussian:ksize=3,sharpen:strength=2")
+    parser.add_argument('--cv2-threads', type=int, default=DEFAULT_SETTINGS['cv2_threads'],
+                        help="OpenCV threads per worker process, 0 divides the cores between the workers")
+    parser.add_argument('--tile-height', type=int, default=DEFAULT_SETTINGS['tile_height'])
+    parser.add_argument('--supersample', action='store_true')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS)
+    parser.add_argument('--pages-per-file', type=int, default=1, help="Pages per file for the extract stage")
+    parser.add_argument('--keep-images', action='store_true')
+    parser.add_argument('--no-cache', action='store_true')
+    parser.add_argument('--no-passthrough', action='store_true')
+    parser.add_argument('--report', help="Write a run report (JSON and CSV) to this path")
+    parser.add_argument('--profile', action='store_true', help="Also dump cProfile stats next to the report")
+    parser.add_argument('--queue', action='store_true',
+                        help="Treat the source folder as an intake shared with other nodes, claiming one PDF at a time")
+    parser.add_argument('--lease', type=float, default=LEASE_SECONDS,
+                        help="Seconds without a heartbeat before another worker takes a claim over")
+    parser.add_argument('--max-attempts', type=int, default=MAX_ATTEMPTS)
+    args = parser.parse_args(argv)
+
+    if args.queue and (args.stages != ['process'] or not os.path.isdir(args.source)):
+        parser.error("--queue needs a source folder and the process stage")
+
+    try:
+        args.filters = parse_filters(args.filters)
+    except ValueError as e:
+        parser.error(f"invalid filters: {e}")
+
+    return args
+
+def load_manifest(source):
+    if os.path.isdir(source):
+        pdf_files = get_files_with_extension(source, '.pdf')
+        pdf_files.sort(key=natural_sort_key)
+        return [os.path.join(source, pdf_file) for pdf_file in pdf_files]
+
+    with open(source) as manifest:
+        if source.lower().endswith('.json'):
+            entries = json.load(manifest)
+        else:
+            entries = [line.strip() for line in manifest if line.strip() and not line.startswith('#')]
+
+    # Relative entries are relative to the manifest
+    manifest_folder = os.path.dirname(os.path.abspath(source))
+    return [os.path.join(manifest_folder, entry) for entry in entries]
+
+def run_batch(args):
+    start_time = time.perf_counter()
+
+    if args.queue:
+        return run_queue_batch(args, start_time)
+
+    try:
+        pdf_files = load_manifest(args.source)
+    except (OSError, ValueError) as e:
+        print(f"Error reading batch source '{args.source}': {e}")
+        return EXIT_USAGE
+
+    missing_files = [pdf_file for pdf_file in pdf_files if not os.path.isfile(pdf_file)]
+    for pdf_file in missing_files:
+        print(f"Missing PDF file: {pdf_file}")
+
+    settings = batch_settings(args)
+    pdf_files = [pdf_file for pdf_file in pdf_files if pdf_file not in missing_files]
+    failed = len(missing_files)
+    processed_folders = []
+    failed_folders = []
+
+    if args.report:
+        start_report(args.profile)
+
+    try:
+        for stage in args.stages:
+            if stage == 'process':
+                processed_folders, stage_failed = process_pdfs(pdf_files, settings, args.keep_images, args.workers)
+                failed += stage_failed
+                continue
+
+            if stage == 'extract':
+                processed_folders, stage_failed = extract_pages(pdf_files, args.pages_per_file, args.workers,
+                                                                failed_folders)
+                failed += stage_failed
+                continue
+
+            # Without an extract stage, work on the folders already sitting next to the source
+            if not processed_folders:
+                root_folder = args.source if os.path.isdir(args.source) else os.path.dirname(os.path.abspath(args.source))
+                # Finished output folders from earlier runs are left alone
+                scan_folders(processed_folders, root_folder, skip_merged=True)
+
+            # Folders with failed pages keep their sources for a retry and are not converted or merged
+            ready_folders = [folder for folder in processed_folders if folder not in failed_folders]
+
+            if stage == 'treat':
+                failed += treat_images(processed_folders, args.workers, settings, failed_folders)
+            elif stage == 'convert':
+                failed += convert_image_to_pdf(ready_folders)
+            elif stage == 'merge':
+                failed += merge_pdfs(ready_folders)
+
+    except Exception as e:
+        print(f"Batch stopped: {e}")
+        failed += 1
+
+    finally:
+        if args.report:
+            stop_report(args.report)
+
+    elapsed = time.perf_counter() - start_time
+    print(f"Batch complete: {len(pdf_files)} document(s), {len(processed_folders)} folder(s), "
+          f"{failed} failure(s) in {elapsed:.1f}s.")
+
+    return EXIT_FAILED if failed else EXIT_OK
+
+def batch_settings(args):
+    return {**DEFAULT_SETTINGS, 'dpi': args.dpi, 'max_width': args.max_width, 'quality': args.quality,
+            'color_mode': args.color_mode, 'filters': args.filters, 'cv2_threads': args.cv2_threads,
+            'tile_height': args.tile_height, 'supersample': args.supersample, 'cache': not args.no_cache,
+            'passthrough': not args.no_passthrough}
+
+def run_queue_batch(args, start_time):
+    if args.report:
+        start_report(args.profile)
+
+    try:
+        processed, failed = run_queue(args.source, batch_settings(args), args.keep_images, args.workers,
+                                      args.lease, args.max_attempts)
+    except Exception as e:
+        print(f"Queue stopped: {e}")
+        processed, failed = 0, 1
+
+    finally:
+        if args.report:
+            stop_report(args.report)
+
+    elapsed = time.perf_counter() - start_time
+    print(f"Queue worker {queue_worker_id()} done: {processed} document(s), {failed} failure(s) in {elapsed:.1f}s.")
+
+    return EXIT_FAILED if failed else EXIT_OK
+
 if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        sys.exit(run_batch(parse_args(sys.argv[1:])))
     main()
 